@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded in-process cache that counts its hits and misses."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete_where(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries)
+        }
+
+
+class VersionedCache(object):
+    """
+    What compile(instance) builds from a model instance and the rows hanging off it, kept in this
+    process under version_of(instance). The signals that change those rows bump the instance's
+    updated_at, so an instance loaded after a change never gets a stale value, whichever process
+    cached it; invalidate() only frees the stale entries of this process early. With a
+    shared_prefix, values are also shared between processes through Django's cache.
+    """
+
+    def __init__(self, max_size, compile, shared_prefix=None, shared_timeout=None):
+        self.compile = compile
+        self.shared_prefix = shared_prefix
+        self.shared_timeout = shared_timeout
+        self._entries = LRUCache(max_size)
+
+    def get(self, instance):
+        version = version_of(instance)
+        value = self._entries.get(version)
+        if value is not None:
+            return value
+
+        if self.shared_prefix is None:
+            value = self.compile(instance)
+        else:
+            shared_key = "%s:%d:%s" % ((self.shared_prefix, ) + version)
+            value = cache.get(shared_key)
+            if value is None:
+                value = self.compile(instance)
+                cache.set(shared_key, value, self.shared_timeout)
+        self._entries.set(version, value)
+        return value
+
+    def invalidate(self, pk):
+        self._entries.delete_where(lambda key: key[0] == pk)
+
+    def stats(self):
+        return self._entries.stats()
+
+
+def version_of(instance):
+    return instance.pk, instance.updated_at.isoformat() if instance.updated_at else ''
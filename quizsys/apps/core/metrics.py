@@ -0,0 +1,260 @@
+"""
+Counters and histograms of the grading pipeline, in the Prometheus text format.
+
+Every process (web server or grading worker) keeps its own metrics and writes them to a file of
+its own in GRADER_METRICS_PATH, at most once every GRADER_METRICS_FLUSH_INTERVAL seconds. The file
+is named after the pid and start time of the process, which holds a lock on it while it lives.
+Counts of processes that are gone still belong to the totals: collect() folds their files into
+one file of exited processes, then sums all the files into one exposition for a scraper; see the
+metrics endpoint and the grading_metrics command.
+"""
+import atexit
+import bisect
+import collections
+import fcntl
+import glob
+import os
+import threading
+import time
+
+from quizsys.settings import GRADER_METRICS_PATH, GRADER_METRICS_FLUSH_INTERVAL
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# counts of the processes that exited, summed into one file by collect()
+EXITED_FILE = 'exited.prom'
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self.last_flush = 0
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.lock_fd = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def check_fork(self):
+        if self.pid != os.getpid():
+            with self._lock:
+                if self.pid != os.getpid():
+                    # a forked child starts from zero, what it inherited is counted in its parent's file
+                    for metric in self.metrics:
+                        metric.reset()
+                    self.pid = os.getpid()
+                    self.started = time.time()
+                    self.last_flush = 0
+                    # the parent keeps its own lock, the child takes one on a file of its own
+                    if self.lock_fd is not None:
+                        os.close(self.lock_fd)
+                        self.lock_fd = None
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def flush(self, force=False):
+        """Write the metrics of this process to its file, unless that was done a moment ago."""
+        if not GRADER_METRICS_PATH:
+            return
+        self.check_fork()
+        now = time.time()
+        with self._lock:
+            if not force and now - self.last_flush < GRADER_METRICS_FLUSH_INTERVAL:
+                return
+            self.last_flush = now
+            os.makedirs(GRADER_METRICS_PATH, exist_ok=True)
+            # a later process with the same pid must not overwrite the file of this one
+            path = os.path.join(GRADER_METRICS_PATH, "%d-%d.prom" % (os.getpid(), self.started * 1000))
+            if self.lock_fd is None:
+                # held until the process exits, telling collect() the file is still in use
+                self.lock_fd = os.open(path[:-len(".prom")] + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            # written aside and renamed, so collect() never reads half a file
+            with open(path + ".tmp", 'w') as metrics_file:
+                metrics_file.write(self.render())
+            os.rename(path + ".tmp", path)
+
+
+registry = Registry()
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format(self, name, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return name
+        return "%s{%s}" % (name, ",".join('%s="%s"' % pair for pair in pairs))
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)] + \
+            ["%s %r" % (sample, float(value)) for sample, value in self.samples()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = collections.defaultdict(float)
+
+    def reset(self):
+        with self._lock:
+            self.values.clear()
+
+    def inc(self, amount=1, **labels):
+        registry.check_fork()
+        with self._lock:
+            self.values[self._key(labels)] += amount
+        registry.flush()
+
+    def samples(self):
+        with self._lock:
+            return [(self._format(self.name, key), value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # per label values: [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def reset(self):
+        with self._lock:
+            self.values.clear()
+
+    def observe(self, value, **labels):
+        registry.check_fork()
+        key = self._key(labels)
+        with self._lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            self.values[key][0][bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key][1] += value
+        registry.flush()
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(float(bound))
+                    samples.append((self._format(self.name + "_bucket", key, [('le', le)]), cumulative))
+                samples.append((self._format(self.name + "_sum", key), total))
+                samples.append((self._format(self.name + "_count", key), cumulative))
+        return samples
+
+
+def collect():
+    """Sum the metrics files of every process into one exposition."""
+    if not GRADER_METRICS_PATH:
+        return registry.render()
+    registry.flush(force=True)
+    fold_exited()
+    return _render(_read(sorted(glob.glob(os.path.join(GRADER_METRICS_PATH, "*.prom")))))
+
+
+def fold_exited():
+    """Add the files of processes that exited to EXITED_FILE and remove them."""
+    exited_path = os.path.join(GRADER_METRICS_PATH, EXITED_FILE)
+    with open(os.path.join(GRADER_METRICS_PATH, "fold.lock"), 'w') as fold_lock:
+        # one collect() folds at a time, or two could add the same file
+        fcntl.flock(fold_lock, fcntl.LOCK_EX)
+        exited = [path for path in glob.glob(os.path.join(GRADER_METRICS_PATH, "*.prom"))
+                  if path != exited_path and not _in_use(path)]
+        if not exited:
+            return
+        with open(exited_path + ".tmp", 'w') as metrics_file:
+            metrics_file.write(_render(_read([exited_path] + exited)))
+        os.rename(exited_path + ".tmp", exited_path)
+        for path in exited:
+            for leftover in (path, path[:-len(".prom")] + ".lock"):
+                try:
+                    os.remove(leftover)
+                except FileNotFoundError:
+                    pass
+
+
+def _in_use(path):
+    try:
+        lock_fd = os.open(path[:-len(".prom")] + ".lock", os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(lock_fd)
+    return False
+
+
+def _read(paths):
+    # family name: [HELP and TYPE lines, {sample: value}]
+    families = collections.OrderedDict()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as metrics_file:
+            family = None
+            for line in metrics_file:
+                line = line.strip()
+                if line.startswith("#"):
+                    name = line.split(" ")[2]
+                    family = families.setdefault(name, [collections.OrderedDict(), collections.OrderedDict()])
+                    family[0][line] = None
+                elif line and family is not None:
+                    sample, value = line.rsplit(" ", 1)
+                    family[1][sample] = family[1].get(sample, 0.0) + float(value)
+    return families
+
+
+def _render(families):
+    lines = []
+    for headers, values in families.values():
+        lines += list(headers)
+        lines += ["%s %r" % (sample, value) for sample, value in values.items()]
+    return "\n".join(lines) + "\n"
+
+
+def gauge(name, help, samples):
+    """Exposition of a gauge measured on the spot, from a list of (labels dict, value)."""
+    lines = ["# HELP %s %s" % (name, help), "# TYPE %s gauge" % name]
+    for labels, value in samples:
+        pairs = ",".join('%s="%s"' % pair for pair in sorted(labels.items()))
+        lines.append("%s{%s} %r" % (name, pairs, float(value)) if pairs else "%s %r" % (name, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+atexit.register(registry.flush, force=True)
+
+
+QUEUE_WAIT_SECONDS = Histogram('quizsys_grading_queue_wait_seconds',
+                               'Time from queueing a grading task to a worker starting it', ['queue'])
+TASKS = Counter('quizsys_grading_tasks_total', 'Grading tasks handled by the workers', ['queue', 'outcome'])
+GRADING_SECONDS = Histogram('quizsys_grading_seconds', 'Time to grade one question submission', ['type'])
+TESTCASES = Counter('quizsys_grading_testcases_total', 'Test cases run against coding submissions', ['result'])
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class QuestionAppConfig(AppConfig):
+    name = 'quizsys.apps.questions'
+    label = 'questions'
+    verbose_name = 'Questions'
+
+    def ready(self):
+        import quizsys.apps.questions.signals
+
+default_app_config = 'quizsys.apps.questions.QuestionAppConfig'
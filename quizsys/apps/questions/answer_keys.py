@@ -0,0 +1,34 @@
+from collections import namedtuple
+
+from quizsys.apps.core.caches import VersionedCache
+from quizsys.settings import GRADER_ANSWER_KEY_CACHE_SIZE
+
+# correct_choices: pks (as strings) of the correct choices of a MCQ question
+# accepted_answers: accepted contents of a FIB question
+AnswerKey = namedtuple('AnswerKey', ('correct_choices', 'accepted_answers'))
+
+CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_answer_key(question):
+    """
+    Answer key of an objective question, served from this process, then from Django's cache and
+    only then built from the database.
+    """
+    return _answer_keys.get(question)
+
+
+def compile_answer_key(question):
+    if question.type == 'MCQ':
+        correct_choices = question.choices.filter(is_correct_answer=True).values_list('pk', flat=True)
+        return AnswerKey(frozenset(str(pk) for pk in correct_choices), frozenset())
+    if question.type == 'FIB':
+        return AnswerKey(frozenset(), frozenset(question.answers.values_list('content', flat=True)))
+    return AnswerKey(frozenset(), frozenset())
+
+
+def invalidate_answer_key(question_pk):
+    _answer_keys.invalidate(question_pk)
+
+
+_answer_keys = VersionedCache(GRADER_ANSWER_KEY_CACHE_SIZE, compile_answer_key, 'answer-key', CACHE_TIMEOUT)
@@ -0,0 +1,36 @@
+import hashlib
+
+from quizsys.apps.core.caches import LRUCache
+from quizsys.settings import GRADER_RESULT_CACHE_SIZE
+
+
+class GradingResultCache(LRUCache):
+    """
+    grade_question results of coding questions, keyed on the question, the exact test cases the
+    code was run against, the limits it ran under and the code, see normalize_code(). Editing a
+    test case changes the key anyway; invalidate_question() just frees the stale entries early.
+    """
+
+    def make_key(self, question, testcases, code):
+        digest = hashlib.sha256()
+        for testcase in testcases:
+            digest.update(("%d\0%s\0%s\0" % (testcase.pk, testcase.input, testcase.output)).encode('utf-8'))
+        limits = "\1%s\0%s\1" % (question.effective_time_limit, question.effective_memory_limit)
+        digest.update(limits.encode('utf-8'))
+        digest.update(normalize_code(code).encode('utf-8'))
+        return question.pk, digest.hexdigest()
+
+    def invalidate_question(self, question_pk):
+        self.delete_where(lambda key: key[0] == question_pk)
+
+
+def normalize_code(code):
+    """
+    Normalize only the line endings, which Python reads the same way even inside string literals, and the blank
+    lines at the end; anything else, even leading blank lines, can change the output or the line numbers
+    of a traceback.
+    """
+    return code.replace('\r\n', '\n').replace('\r', '\n').rstrip('\n')
+
+
+result_cache = GradingResultCache(GRADER_RESULT_CACHE_SIZE)
@@ -1,42 +1,48 @@
-import re
+import ast
 
 import os
 import signal
 import subprocess
-
+import tempfile
 import time
+import traceback
 from decouple import config
 
-from quizsys.settings import CODE_PATH
+from quizsys.apps.core.caches import LRUCache, version_of
+from quizsys.apps.core.metrics import GRADING_SECONDS, TESTCASES
+from quizsys.apps.questions import sandbox
+from quizsys.apps.questions.answer_keys import get_answer_key
+from quizsys.apps.questions.caches import result_cache
+from quizsys.apps.questions.materials import get_grading_material
+from quizsys.apps.questions.models import Question
+from quizsys.apps.questions.sandbox_server import limit_resources, capture, testcase_result, OutputComparator, \
+    TIMED_OUT
+from quizsys.settings import GRADER_POOL_SIZE, GRADER_DEFAULT_TIME_LIMIT, GRADER_MAX_OUTPUT_BYTES, \
+    GRADER_MATERIAL_CACHE_SIZE
+
+
+def grade_question(question, response, sample_test=False):
+    started = time.time()
+    try:
+        return _grade_question(question, response, sample_test)
+    finally:
+        GRADING_SECONDS.observe(time.time() - started, type=question.type)
 
 
-def grade_question(question, response, file_suffix=None, sample_test=False):
+def _grade_question(question, response, sample_test):
     if question.type == 'MCQ':
-        correct_choices = question.choices.filter(is_correct_answer=True)
-        correct_choice_pks = sorted([str(choice.pk) for choice in correct_choices])
-        correct_choices_str = ';'.join(correct_choice_pks)
-
-        response = ";".join(sorted(response.split(";")))
-        return {"status": response == correct_choices_str}
+        correct_choices = get_answer_key(question).correct_choices
+        chosen = response.split(";") if response else []
+        # the length check keeps a repeated choice wrong, as it was when comparing sorted strings
+        return {"status": len(chosen) == len(correct_choices) and frozenset(chosen) == correct_choices}
     if question.type == 'FIB':
-        status = False
-        accepted_answers = question.answers
-        accepted_answers_content = [accepted_answer.content for accepted_answer in accepted_answers.all()]
-        for accepted_answer in accepted_answers_content:
-            if response == accepted_answer:
-                status = True
-        return {"status": status}
+        return {"status": response in get_answer_key(question).accepted_answers}
 
     # question.type == "COD" - coding question
 
-    if re.search(r"import\s+os", response) or re.search(r"import\s+subprocess", response):
-        return {"status": False}
-
-    if not os.path.exists(CODE_PATH):
-        os.makedirs(CODE_PATH)
-
     status = True
-    testcases = question.testcases.all()
+    material = get_grading_material(question)
+    testcases = material.testcases
     if sample_test:
         testcases = testcases[:3]
     else:
@@ -45,65 +51,199 @@ def grade_question(question, response, file_suffix=None, sample_test=False):
     failed_testcases = ["quizsys"] # really sorry for this line of code, should be [], but this is necessary when displaying the green color for the correct test cases in the case that all tests are passed
     errors = set([])
 
-    code = get_code(question, response)
+    code = get_code(material.template, response)
     if code == "":
         return {"status": False, "extra_info": ";".join([str(tc.pk) for tc in testcases])}
 
-    for testcase in testcases:
-        # input = testcase.input.replace("\n", "\\n").replace("\t", "\\t")
-        output = testcase.output
-        # header = "import sys\nimport io\nsys.stdin = io.StringIO(\"%s\")\n" % input
-        # extended_code = header + code
-        extended_code = code
-
-        script_path = os.path.join(CODE_PATH, "script_" + str(file_suffix) + ".py")
-        with open(script_path, 'w') as f:
-            f.write(extended_code)
-
-        submitted_output, submitted_error = run_script(script_path, testcase.input)
-        if submitted_output != output.strip():
-            print("Failed %s != %s" % (submitted_output, output.strip()))
+    preflight_error = preflight(code)
+    if preflight_error is not None:
+        return {
+            'status': False,
+            'extra_info': ";".join(failed_testcases + ["%d-" % testcase.pk for testcase in testcases]),
+            'code_errors': preflight_error,
+            'score': 0.0
+        }
+
+    if question.reference_solution and question.reference_runtime is None:
+        calibrate_time_limit(question)
+
+    cache_key = result_cache.make_key(question, testcases, code)
+    cached_result = result_cache.get(cache_key)
+    if cached_result is not None:
+        return dict(cached_result)
+
+    # a timeout may be down to the load of the host and a sandbox error is never the code's fault,
+    # so results with either are not cached and the same code gets another chance
+    cacheable = True
+    results = run_testcases(code, [testcase.input for testcase in testcases],
+                            question.effective_time_limit, question.effective_memory_limit,
+                            [testcase.output for testcase in testcases])
+    # read to the end, not zipped: the sandbox job is only finished, and its interpreter handed back
+    # to the pool, once the results generator is exhausted
+    for index, result in enumerate(results):
+        testcase = testcases[index]
+        submitted_output, submitted_error = result['output'], result['error']
+        TESTCASES.inc(result='timeout' if result['timed_out'] else 'passed' if result['passed'] else 'failed')
+        if result['timed_out'] or result.get('sandbox_error'):
+            cacheable = False
+        if not result['passed']:
             failed_testcases.append("%d-%s" % (testcase.pk, submitted_output))
-            errors.add(submitted_error)
+            # where the output went wrong, unless an error already tells why
+            if submitted_error:
+                errors.add(submitted_error)
+            elif result['mismatch_offset'] is not None:
+                errors.add("Test case %d: output differs from the expected output at byte %d"
+                           % (testcase.pk, result['mismatch_offset']))
             status = False
 
     # print(failed_testcases)
-    return {
+    result = {
         'status': status,
         'extra_info': ";".join([failed_testcase for failed_testcase in failed_testcases]),
         'code_errors': "; ".join(list(errors)),
-        'score': (testcases.count() - len(failed_testcases)) * 1.0 / testcases.count()
+        'score': (len(testcases) - len(failed_testcases)) * 1.0 / len(testcases)
     }
-
-
-def run_script(script_path, input=""):
-    command = [config('PYTHON_PATH'), script_path]
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    if cacheable:
+        result_cache.set(cache_key, result)
+    return dict(result)
+
+
+FORBIDDEN_MODULES = frozenset([
+    'os', 'posix', 'subprocess', 'shutil', 'pathlib', 'socket', 'ctypes', 'multiprocessing', 'threading',
+    'signal', 'pty', 'fcntl', 'resource', 'importlib', 'builtins',
+])
+# eval, exec and compile are common in student code (eval(input()) most of all) and are not blocked:
+# whatever they run is still held to the resource limits of the sandbox
+FORBIDDEN_CALLS = frozenset(['__import__', 'open', 'breakpoint'])
+FORBIDDEN_ATTRIBUTES = frozenset(['__subclasses__', '__globals__', '__builtins__', '__code__', '__import__'])
+
+
+def preflight(code):
+    """
+    Reject code that cannot compile or that uses a forbidden module, call or attribute before
+    any sandbox is involved. Returns the error to show the student, or None if the code may run.
+    """
     try:
-        submitted_output, submitted_error = proc.communicate(input.encode('utf-8'), timeout=5)
-    except subprocess.TimeoutExpired:
-        # print("subprocess.TimeoutExpired")
-        return "", "RuntimeError: Your program may not terminate"
-
-    os.remove(script_path)
-    submitted_output = submitted_output.decode('utf-8').strip()
-    submitted_error = submitted_error.decode('utf-8').strip()
-
-    if submitted_error != "":
-        submitted_error = submitted_error.split("\n")[-1]
-    return submitted_output, submitted_error
-
-
-def get_code(question, response):
-    if not question.extra or question.extra == "" or len(re.findall(r'___+', question.extra)) == 0:
+        tree = ast.parse(code, '<script>')
+        # some errors (e.g. 'return' outside function) are only raised when compiling the tree
+        compile(tree, '<script>', 'exec')
+    except (SyntaxError, ValueError) as exc:
+        return traceback.format_exception_only(type(exc), exc)[-1].strip()
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        else:
+            modules = []
+        for module in modules:
+            if module.split('.')[0] in FORBIDDEN_MODULES:
+                return "ImportError: Importing %s is not allowed" % module
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FORBIDDEN_CALLS:
+            return "NameError: Calling %s is not allowed" % node.func.id
+        if isinstance(node, ast.Name) and node.id in FORBIDDEN_ATTRIBUTES:
+            return "NameError: Using %s is not allowed" % node.id
+        if isinstance(node, ast.Attribute) and node.attr in FORBIDDEN_ATTRIBUTES:
+            return "AttributeError: Using %s is not allowed" % node.attr
+    return None
+
+
+def run_testcases(code, inputs, time_limit=5, memory_limit=None, expected_outputs=None):
+    """
+    Yield the result of every input, in order, as described in sandbox.run_batch. With
+    expected_outputs, a program is stopped as soon as its output goes wrong.
+    """
+    if GRADER_POOL_SIZE > 0:
+        # one sandbox job for the whole submission, results stream back in test case order
+        for result in sandbox.run_batch(code, inputs, time_limit, memory_limit, expected_outputs):
+            yield result
+        return
+
+    for index, input in enumerate(inputs):
+        expected = expected_outputs[index] if expected_outputs is not None else None
+        yield run_script(code, input, time_limit, memory_limit, expected)
+
+
+def run_script(code, input="", timeout=5, memory_limit=None, expected=None):
+    # the code goes in through an unlinked file passed down as a descriptor: concurrent gradings never
+    # share or race on a path, and unlike a -c argument its size is not capped by the argv limit
+    in_r, in_w = os.pipe()
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    started = time.time()
+    try:
+        with tempfile.TemporaryFile() as code_file:
+            code_file.write(code.encode('utf-8'))
+            code_file.flush()
+            command = [config('PYTHON_PATH'), '/dev/fd/%d' % code_file.fileno()]
+            proc = subprocess.Popen(command, stdin=in_r, stdout=out_w, stderr=err_w, start_new_session=True,
+                                    pass_fds=(code_file.fileno(),),
+                                    preexec_fn=lambda: limit_resources(timeout, memory_limit))
+    except OSError:
+        for fd in (in_w, out_r, err_r):
+            os.close(fd)
+        raise
+    finally:
+        for fd in (in_r, out_w, err_w):
+            os.close(fd)
+
+    comparator = OutputComparator(expected) if expected is not None else None
+    try:
+        output, error, stopped = capture(out_r, err_r, started + timeout, comparator, GRADER_MAX_OUTPUT_BYTES,
+                                         in_w, input.encode('utf-8'))
+    finally:
+        # the program leads its own process group, take down anything it started along with it
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+        os.close(out_r)
+        os.close(err_r)
+    if proc.returncode == -signal.SIGXCPU:
+        stopped = TIMED_OUT
+    return testcase_result(output, error, stopped, comparator, time.time() - started)
+
+
+def calibrate_time_limit(question):
+    """
+    Time the reference solution of a coding question, see Question.effective_time_limit. The time
+    only counts if the solution passes every test case; if it does not, the question keeps the
+    default time limit and this version of it is not timed again.
+    """
+    version = version_of(question)
+    if _failed_calibrations.get(version):
+        return
+    testcases = get_grading_material(question).testcases
+    results = list(run_testcases(question.reference_solution, [testcase.input for testcase in testcases],
+                                 GRADER_DEFAULT_TIME_LIMIT, question.effective_memory_limit,
+                                 [testcase.output for testcase in testcases]))
+    failed = [testcase.pk for testcase, result in zip(testcases, results) if not result['passed']]
+    if failed:
+        print("[x] Reference solution of question %d failed test cases %r, using the default time limit"
+              % (question.pk, failed))
+        _failed_calibrations.set(version, True)
+        return
+    question.reference_runtime = max([result['elapsed'] for result in results] or [0])
+    Question.objects.filter(pk=question.pk).update(reference_runtime=question.reference_runtime)
+
+
+# versions of questions whose reference solution failed, so they are not timed on every submission
+_failed_calibrations = LRUCache(GRADER_MATERIAL_CACHE_SIZE)
+
+
+def get_code(template, response):
+    """Fill the blanks of a fill-in coding question (see GradingMaterial.template) with the ;-separated response."""
+    if template is None:
         return response
 
-    code = question.extra
     fill_ins = response.split(";")
-    blanks = re.findall(r'___+', code)
-    if len(fill_ins) != len(blanks):
+    if len(fill_ins) != len(template) - 1:
         return ""
 
-    for i in range(len(blanks)):
-        code = code.replace(blanks[i], fill_ins[i], 1)
-    return code
+    code = [template[0]]
+    for fill_in, part in zip(fill_ins, template[1:]):
+        code += [fill_in, part]
+    return "".join(code)
@@ -0,0 +1,67 @@
+import time
+
+import pika
+from django.core.management.base import BaseCommand
+
+from quizsys.apps.quizzes.models import GradingJob
+from quizsys.settings import BROKER_HOST, GRADER_QUEUE_BACKEND
+from quizsys.task_queue.backends import BACKENDS, PikaBackend
+
+BENCH_QUEUE = 'bench_publish_queue'
+
+
+class Command(BaseCommand):
+    help = 'Measure the latency of queueing a grading task and how fast a consumer drains the queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=300)
+        parser.add_argument('--backend', choices=sorted(BACKENDS), default=GRADER_QUEUE_BACKEND)
+        parser.add_argument('--prefetch', type=int, default=1)
+
+    def handle(self, *args, **options):
+        messages = options['messages']
+        backend = BACKENDS[options['backend']]()
+
+        if isinstance(backend, PikaBackend):
+            started = time.time()
+            for pk in range(messages):
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=BROKER_HOST))
+                channel = connection.channel()
+                channel.queue_declare(queue=BENCH_QUEUE, durable=True)
+                channel.basic_publish(exchange='', routing_key=BENCH_QUEUE, body=str(pk),
+                                      properties=pika.BasicProperties(delivery_mode=2))
+                connection.close()
+            self._report('connection per task', started, messages)
+
+        try:
+            started = time.time()
+            for pk in range(messages):
+                backend.publish(BENCH_QUEUE, str(pk))
+            self._report('publish (%s)' % options['backend'], started, messages)
+
+            backend.start_consuming([BENCH_QUEUE], options['prefetch'])
+            started = finished = time.time()
+            consumed = 0
+            while True:
+                delivery = backend.get(1)
+                if delivery is None:
+                    break
+                backend.ack(delivery)
+                consumed += 1
+                finished = time.time()
+            self._report('consume (%s)' % options['backend'], started, consumed, finished)
+        finally:
+            backend.close()
+            self._cleanup(backend)
+
+    def _cleanup(self, backend):
+        if isinstance(backend, PikaBackend):
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=BROKER_HOST))
+            connection.channel().queue_delete(queue=BENCH_QUEUE)
+            connection.close()
+        else:
+            GradingJob.objects.filter(queue=BENCH_QUEUE).delete()
+
+    def _report(self, label, started, messages, finished=None):
+        elapsed = (finished or time.time()) - started
+        self.stdout.write("%-20s %4d tasks  %8.2f ms per task" % (label, messages, elapsed * 1000 / max(messages, 1)))
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from quizsys.apps.questions.graders import run_script
+from quizsys.apps.questions.sandbox import InterpreterPool
+
+BENCH_CODE = "n = int(input())\nprint(sum(range(n)))\n"
+BENCH_INPUT = "1000\n"
+
+
+class Command(BaseCommand):
+    help = 'Measure the per test case overhead of running student code: fresh interpreters, pooled and batched'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=200)
+        parser.add_argument('--pool-size', type=int, default=1)
+
+    def handle(self, *args, **options):
+        runs = options['runs']
+
+        started = time.time()
+        for _ in range(runs):
+            run_script(BENCH_CODE, BENCH_INPUT)
+        self._report('fresh interpreter', started, runs)
+
+        pool = InterpreterPool(size=options['pool_size'])
+        try:
+            started = time.time()
+            for _ in range(runs):
+                pool.run(BENCH_CODE, BENCH_INPUT)
+            self._report('interpreter pool', started, runs)
+
+            started = time.time()
+            for _ in pool.run_batch(BENCH_CODE, [BENCH_INPUT] * runs):
+                pass
+            self._report('batched job', started, runs)
+        finally:
+            pool.close()
+
+    def _report(self, label, started, runs):
+        elapsed = time.time() - started
+        self.stdout.write("%-20s %4d runs  %8.2f ms per test case" % (label, runs, elapsed * 1000 / runs))
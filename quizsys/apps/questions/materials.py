@@ -0,0 +1,33 @@
+import re
+from collections import namedtuple
+
+from quizsys.apps.core.caches import VersionedCache
+from quizsys.settings import GRADER_MATERIAL_CACHE_SIZE
+
+BLANK = re.compile(r'___+')
+
+# testcases: the test cases of a coding question, in the order the grader splits them
+# template: the code of a fill-in coding question split around its blanks, None if it has none
+GradingMaterial = namedtuple('GradingMaterial', ('testcases', 'template'))
+
+
+def get_grading_material(question):
+    """
+    What grading a coding question needs besides the question row itself, kept so that grading
+    the same question again does not query it.
+    """
+    return _materials.get(question)
+
+
+def compile_grading_material(question):
+    template = None
+    if question.extra and BLANK.search(question.extra):
+        template = tuple(BLANK.split(question.extra))
+    return GradingMaterial(tuple(question.testcases.all()), template)
+
+
+def invalidate_grading_material(question_pk):
+    _materials.invalidate(question_pk)
+
+
+_materials = VersionedCache(GRADER_MATERIAL_CACHE_SIZE, compile_grading_material)
@@ -1,6 +1,11 @@
+import json
+
 from django.db import models
 
 from quizsys.apps.core.models import TimestampedModel
+from quizsys.apps.questions.answer_keys import get_answer_key
+from quizsys.settings import GRADER_DEFAULT_TIME_LIMIT, GRADER_DEFAULT_MEMORY_LIMIT, GRADER_TIME_LIMIT_MULTIPLIER, \
+    GRADER_MIN_TIME_LIMIT
 
 QUESTION_TYPES = (
     ('MCQ', 'Multiple Choice Question'),
@@ -8,6 +13,12 @@ QUESTION_TYPES = (
     ('COD', 'Coding Question')
 )
 
+SAMPLE_TEST_STATUSES = (
+    ('PENDING', 'Waiting for a grader'),
+    ('DONE', 'Graded'),
+    ('FAILED', 'Could not be graded')
+)
+
 
 class Question(TimestampedModel):
     title = models.CharField(max_length=255, unique=True, null=True)
@@ -16,12 +27,32 @@ class Question(TimestampedModel):
     extra = models.TextField(blank=True)
     tags = models.ManyToManyField('questions.Tag', related_name='questions')
 
+    # limits per test case of coding questions, in seconds and MB; empty means derived/default
+    time_limit = models.FloatField(null=True, blank=True)
+    memory_limit = models.PositiveIntegerField(null=True, blank=True)
+    reference_solution = models.TextField(blank=True)
+    # slowest test case of the reference solution, measured by the grader; reset when it may change
+    reference_runtime = models.FloatField(null=True, blank=True)
+
     def __str__(self):
         return self.title
 
+    @property
+    def effective_time_limit(self):
+        if self.time_limit:
+            return self.time_limit
+        if self.reference_runtime is not None:
+            adaptive_limit = self.reference_runtime * GRADER_TIME_LIMIT_MULTIPLIER
+            return min(max(adaptive_limit, GRADER_MIN_TIME_LIMIT), GRADER_DEFAULT_TIME_LIMIT)
+        return GRADER_DEFAULT_TIME_LIMIT
+
+    @property
+    def effective_memory_limit(self):
+        return self.memory_limit or GRADER_DEFAULT_MEMORY_LIMIT
+
     @property
     def number_of_correct_choices(self):
-        return self.choices.filter(is_correct_answer=True).count()
+        return len(get_answer_key(self).correct_choices)
 
 
 # choice of mcq questions
@@ -61,4 +92,17 @@ class Tag(TimestampedModel):
         return self.content
 
 
+# sample test run of a student, graded by the task queue worker instead of the web request
+class SampleTestJob(TimestampedModel):
+    question = models.ForeignKey('questions.Question', related_name='sample_test_jobs', on_delete=models.CASCADE)
+    user = models.ForeignKey('users.User', related_name='sample_test_jobs', on_delete=models.CASCADE)
+    response = models.TextField(blank=True)
+    status = models.CharField(choices=SAMPLE_TEST_STATUSES, max_length=10, default='PENDING')
+    results = models.TextField(blank=True) # json of the grade_question result, once graded
+
+    @property
+    def is_finished(self):
+        return self.status != 'PENDING'
 
+    def get_results(self):
+        return json.loads(self.results) if self.results else None
@@ -0,0 +1,259 @@
+import atexit
+import fcntl
+import json
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from decouple import config
+
+from quizsys.apps.questions import sandbox_server
+from quizsys.settings import GRADER_POOL_SIZE, GRADER_MAX_JOBS_PER_CHILD, GRADER_SUBMISSION_CONCURRENCY, \
+    GRADER_HOST_CONCURRENCY, GRADER_LOCK_PATH, GRADER_MAX_OUTPUT_BYTES
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandbox_server.py')
+
+# how much longer than the job itself we wait for a zygote before giving up on it
+ZYGOTE_GRACE_PERIOD = 5
+
+# how long to back off when every host slot is taken
+HOST_SLOT_POLL_INTERVAL = 0.01
+
+
+class SandboxError(Exception):
+    pass
+
+
+class Zygote(object):
+    """
+    A warm sandbox interpreter running sandbox_server.py. Each job is forked off the zygote, so
+    the zygote itself never runs student code.
+    """
+
+    def __init__(self):
+        self.proc = subprocess.Popen([config('PYTHON_PATH'), SERVER_PATH],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.jobs = 0
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run_batch(self, code, inputs, timeout=5, memory_limit=None, expected_outputs=None):
+        """Yield the result of every input, in order, as the zygote streams them back."""
+        self.jobs += 1
+        try:
+            sandbox_server.write_frame(self.proc.stdin.fileno(), {
+                'code': code,
+                'inputs': inputs,
+                'expected': expected_outputs,
+                'timeout': timeout,
+                'memory_limit': memory_limit,
+                'max_output': GRADER_MAX_OUTPUT_BYTES
+            })
+            for _ in inputs:
+                yield self._read_frame(time.time() + timeout + ZYGOTE_GRACE_PERIOD)
+            if not self._read_frame(time.time() + ZYGOTE_GRACE_PERIOD).get('done'):
+                raise SandboxError("Sandbox interpreter is out of sync")
+        except OSError as exc:
+            raise SandboxError("Sandbox interpreter died: %s" % exc)
+
+    def _read_frame(self, deadline):
+        fd = self.proc.stdout.fileno()
+        header = self._read_exact(fd, sandbox_server.HEADER.size, deadline)
+        payload = self._read_exact(fd, sandbox_server.HEADER.unpack(header)[0], deadline)
+        return json.loads(payload.decode('utf-8'))
+
+    def _read_exact(self, fd, size, deadline):
+        chunks = []
+        while size > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise SandboxError("Sandbox interpreter did not answer in time")
+            chunk = os.read(fd, size)
+            if not chunk:
+                raise SandboxError("Sandbox interpreter closed its output")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+
+@contextmanager
+def host_slot():
+    """
+    Hold one of the GRADER_HOST_CONCURRENCY slots shared by every grading process on this host.
+    Slots are flock()ed files, so a slot held by a process that dies is freed by the kernel.
+    """
+    if not os.path.exists(GRADER_LOCK_PATH):
+        os.makedirs(GRADER_LOCK_PATH, exist_ok=True)
+
+    while True:
+        for slot in range(GRADER_HOST_CONCURRENCY):
+            fd = os.open(os.path.join(GRADER_LOCK_PATH, "slot_%d.lock" % slot), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield slot
+            finally:
+                os.close(fd)
+            return
+        time.sleep(HOST_SLOT_POLL_INTERVAL)
+
+
+class InterpreterPool(object):
+    """
+    Fixed-size pool of zygotes. A zygote is handed to one caller at a time and is replaced after
+    max_jobs_per_child jobs, or as soon as it misbehaves.
+    """
+
+    def __init__(self, size=GRADER_POOL_SIZE, max_jobs_per_child=GRADER_MAX_JOBS_PER_CHILD):
+        self.size = size
+        self.max_jobs_per_child = max_jobs_per_child
+        self.pid = os.getpid()
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(Zygote())
+
+    def run_batch(self, code, inputs, timeout=5, memory_limit=None, expected_outputs=None):
+        # retired zygotes are put back as None and respawned by the next caller
+        zygote = self._idle.get()
+        finished = False
+        try:
+            if zygote is not None and not zygote.alive:
+                zygote.close()
+                zygote = None
+            if zygote is None:
+                zygote = Zygote()
+            with host_slot():
+                for result in zygote.run_batch(code, inputs, timeout, memory_limit, expected_outputs):
+                    yield result
+            finished = True
+        finally:
+            # a zygote left with unread results (or a broken one) cannot be handed out again
+            if zygote is not None and (not finished or zygote.jobs >= self.max_jobs_per_child):
+                zygote.close()
+                zygote = None
+            self._idle.put(zygote)
+
+    def run(self, code, input="", timeout=5, memory_limit=None):
+        return list(self.run_batch(code, [input], timeout, memory_limit))[0]
+
+    def close(self):
+        while True:
+            try:
+                zygote = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            if zygote is not None:
+                zygote.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+
+
+def get_pool():
+    """Return the pool of this process, creating it on first use (and again after a fork)."""
+    global _pool, _executor
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = InterpreterPool()
+            _executor = None
+        return _pool
+
+
+def get_executor():
+    """Threads feeding the pool; there is no point in having more of them than zygotes."""
+    global _executor
+    pool = get_pool()
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(pool.size, 1))
+        return _executor
+
+
+@atexit.register
+def _close_pool():
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.close()
+
+
+def run_batch(code, inputs, timeout=5, memory_limit=None, expected_outputs=None,
+              concurrency=GRADER_SUBMISSION_CONCURRENCY):
+    """
+    Run code against every input, yielding a dict with 'output', 'error', 'elapsed',
+    'timed_out', 'passed' and 'mismatch_offset' per input (see sandbox_server.testcase_result).
+    Each input gets `timeout` seconds and `memory_limit` MB; with expected_outputs, its output is
+    checked against the matching expected output while it runs, otherwise 'passed' is None. The inputs
+    are dealt round-robin over up to `concurrency` pooled sandbox jobs running in parallel;
+    results are still yielded in input order, each one as soon as it and all the ones before it
+    are done. If the sandbox breaks down, the inputs it did not get to are reported as failed,
+    with 'sandbox_error' set.
+    """
+    concurrency = max(1, min(concurrency, len(inputs)))
+    if concurrency == 1:
+        for result in _run_chunk(code, inputs, list(range(len(inputs))), timeout, memory_limit, expected_outputs):
+            yield result
+        return
+
+    results = queue.Queue()
+    chunks = [list(range(len(inputs)))[start::concurrency] for start in range(concurrency)]
+    futures = [get_executor().submit(_stream_chunk, code, inputs, chunk, timeout, memory_limit, expected_outputs,
+                                     results)
+               for chunk in chunks]
+
+    finished = {}
+    for index in range(len(inputs)):
+        while index not in finished:
+            result = results.get()
+            if 'exception' in result:
+                raise result['exception']
+            finished[result['index']] = result
+        yield finished.pop(index)
+
+    for future in futures:
+        future.result()
+
+
+def _stream_chunk(code, inputs, indexes, timeout, memory_limit, expected_outputs, results):
+    try:
+        for result in _run_chunk(code, inputs, indexes, timeout, memory_limit, expected_outputs):
+            results.put(result)
+    except Exception as exc:
+        # hand the failure to the caller instead of leaving it waiting for results forever
+        results.put({'exception': exc})
+
+
+def _run_chunk(code, inputs, indexes, timeout, memory_limit, expected_outputs=None):
+    """Run the inputs at the given indexes as one sandbox job, tagging results with those indexes."""
+    if expected_outputs is not None:
+        expected_outputs = [expected_outputs[index] for index in indexes]
+    done = 0
+    try:
+        for result in get_pool().run_batch(code, [inputs[index] for index in indexes], timeout, memory_limit,
+                                           expected_outputs):
+            result['index'] = indexes[done]
+            done += 1
+            yield result
+    except SandboxError as exc:
+        for index in indexes[done:]:
+            yield {'index': index, 'output': '', 'error': "RuntimeError: %s" % exc, 'elapsed': 0,
+                   'timed_out': False, 'passed': False if expected_outputs is not None else None,
+                   'mismatch_offset': None, 'sandbox_error': True}
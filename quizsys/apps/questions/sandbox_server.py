@@ -0,0 +1,355 @@
+"""
+Zygote process of the coding question sandbox.
+
+This file is started with config('PYTHON_PATH') by quizsys.apps.questions.sandbox and is kept
+warm between submissions. It must not import anything from Django or quizsys, since the sandbox
+interpreter does not necessarily have them installed.
+
+Jobs are read from stdin and answered on stdout as length-prefixed JSON frames. A job carries
+the code once and the stdin of every test case; the code is compiled once and every test case
+runs in a freshly forked child, so the interpreter startup, the preloaded modules and the
+compilation are paid once per job instead of once per test case, and nothing a student program
+does survives its test case. One frame is streamed back per test case as soon as it finishes,
+followed by a {"done": true} frame.
+
+When a job carries the expected outputs, the output of every test case is compared while it is
+being read, and a program is stopped at its first wrong byte. The capture helpers below are
+shared with graders.run_script, which runs code without the sandbox pool.
+"""
+import io
+import json
+import math
+import os
+import resource
+import select
+import signal
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+# modules students commonly use, imported once so that the forked children get them for free
+PRELOAD_MODULES = ('math', 're', 'string', 'random', 'itertools', 'functools', 'collections', 'heapq',
+                   'bisect', 'datetime', 'decimal', 'fractions')
+
+HEADER = struct.Struct('>I')
+
+TIMEOUT_ERROR = "RuntimeError: Your program may not terminate"
+OUTPUT_LIMIT_ERROR = "RuntimeError: Your program printed too much output"
+
+# bytes.strip() counterpart of the str.strip() the expected outputs used to be compared with
+WHITESPACE = b' \t\n\r\x0b\x0c'
+
+# only the last line of stderr is shown to the student
+ERROR_TAIL_BYTES = 4096
+
+# why capture() stopped reading before the program closed its output
+TIMED_OUT = 'timed_out'
+MISMATCH = 'mismatch'
+OUTPUT_LIMIT = 'output_limit'
+
+
+def read_frame(fd):
+    header = _read_exact(fd, HEADER.size)
+    if header is None:
+        return None
+    payload = _read_exact(fd, HEADER.unpack(header)[0])
+    if payload is None:
+        return None
+    return json.loads(payload.decode('utf-8'))
+
+
+def write_frame(fd, message):
+    payload = json.dumps(message).encode('utf-8')
+    data = HEADER.pack(len(payload)) + payload
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def _read_exact(fd, size):
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class OutputComparator(object):
+    """
+    Compares the stdout of a program, fed chunk by chunk, with the expected output the way
+    output.strip() == expected.strip() would, holding nothing but a bounded run of trailing
+    whitespace. mismatch_offset is the offset, in the stripped output, of the first byte that
+    differs from the expected output (or where one of them ends early), None while they agree.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected.encode('utf-8').strip(WHITESPACE)
+        self.position = 0
+        self.pending = b''
+        self.started = False
+        self.mismatch_offset = None
+
+    def feed(self, chunk):
+        """Returns False as soon as the output can no longer match."""
+        if self.mismatch_offset is not None:
+            return False
+        if not self.started:
+            chunk = chunk.lstrip(WHITESPACE)
+            if not chunk:
+                return True
+            self.started = True
+
+        body = chunk.rstrip(WHITESPACE)
+        if body:
+            data = self.pending + body
+            self.pending = b''
+            expected = self.expected[self.position:self.position + len(data)]
+            if data != expected:
+                self.mismatch_offset = self.position + _common_prefix_length(data, expected)
+                return False
+            self.position += len(data)
+        # whitespace only counts once something follows it, and one byte more than what is left
+        # of the expected output is enough to tell that it cannot match
+        self.pending = (self.pending + chunk[len(body):])[:len(self.expected) - self.position + 1]
+        return True
+
+    def finish(self):
+        """Call once the output is complete; returns whether it matched."""
+        if self.mismatch_offset is None and self.position < len(self.expected):
+            self.mismatch_offset = self.position
+        return self.mismatch_offset is None
+
+
+def _common_prefix_length(a, b):
+    for index, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return index
+    return min(len(a), len(b))
+
+
+def run_job(job):
+    """
+    Compile job['code'] once and yield one result per entry of job['inputs'], comparing each
+    output with the matching entry of job['expected'] if the job has them.
+    """
+    timeout = job.get('timeout', 5)
+    memory_limit = job.get('memory_limit')
+    max_output = job.get('max_output')
+    expected_outputs = job.get('expected') or [None] * len(job['inputs'])
+    try:
+        code = compile(job['code'], '<script>', 'exec')
+    except (SyntaxError, ValueError) as exc:
+        error = traceback.format_exception_only(type(exc), exc)[-1].strip()
+        for index, expected in enumerate(expected_outputs):
+            yield {'index': index, 'output': '', 'error': error, 'elapsed': 0, 'timed_out': False,
+                   'passed': False if expected is not None else None, 'mismatch_offset': None}
+        return
+
+    for index, (input, expected) in enumerate(zip(job['inputs'], expected_outputs)):
+        result = run_testcase(code, input, timeout, memory_limit, expected, max_output)
+        result['index'] = index
+        yield result
+
+
+def run_testcase(code, input, timeout, memory_limit=None, expected=None, max_output=None):
+    """
+    Run the compiled code with input as stdin in a forked child and collect its output. The child
+    leads its own process group, gets at most `timeout` seconds of wall clock time (and the
+    matching CPU rlimit), `memory_limit` MB of address space and `max_output` bytes of stdout.
+    If `expected` is given, the child is stopped as soon as its output goes wrong.
+    """
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    started = time.time()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(out_r)
+        os.close(err_r)
+        _exec_child(code, input, out_w, err_w, timeout, memory_limit)
+
+    # the child does this too; whichever runs first, the group exists before we could kill it
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    os.close(out_w)
+    os.close(err_w)
+    comparator = OutputComparator(expected) if expected is not None else None
+    try:
+        output, error, stopped = capture(out_r, err_r, started + timeout, comparator, max_output)
+    finally:
+        # the child is not reaped yet, so its pid still names its process group: this takes down
+        # whatever it left behind as well as the child itself when it was stopped early
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        _, status = os.waitpid(pid, 0)
+        os.close(out_r)
+        os.close(err_r)
+    if os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGXCPU:
+        stopped = TIMED_OUT
+    return testcase_result(output, error, stopped, comparator, time.time() - started)
+
+
+def capture(out_fd, err_fd, deadline, comparator=None, max_output=None, in_fd=None, input=b''):
+    """
+    Read the stdout and stderr of a program until it closes them, the deadline passes, its stdout
+    stops agreeing with `comparator` or grows past `max_output` bytes; whichever comes first.
+    If in_fd is given, input is written to it along the way and in_fd is closed afterwards.
+    Only what is needed is kept: stdout up to max_output bytes and the tail of stderr.
+    Returns (stdout, stderr, why reading stopped early or None).
+    """
+    output = bytearray()
+    error = bytearray()
+    read_fds = [out_fd, err_fd]
+    write_fds = []
+    if in_fd is not None:
+        if input:
+            os.set_blocking(in_fd, False)
+            write_fds.append(in_fd)
+        else:
+            os.close(in_fd)
+    stopped = None
+
+    while read_fds and stopped is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            stopped = TIMED_OUT
+            break
+        readable, writable, _ = select.select(read_fds, write_fds, [], remaining)
+        for fd in writable:
+            try:
+                input = input[os.write(fd, input[:65536]):]
+            except BlockingIOError:
+                continue
+            except BrokenPipeError:
+                # the program does not want the rest of its input
+                input = b''
+            if not input:
+                os.close(fd)
+                write_fds.remove(fd)
+        for fd in readable:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                read_fds.remove(fd)
+            elif fd == err_fd:
+                error += chunk
+                del error[:-ERROR_TAIL_BYTES]
+            elif max_output is not None and len(output) + len(chunk) > max_output:
+                stopped = OUTPUT_LIMIT
+                break
+            else:
+                output += chunk
+                if comparator is not None and not comparator.feed(chunk):
+                    stopped = MISMATCH
+                    break
+
+    for fd in write_fds:
+        os.close(fd)
+    return bytes(output), bytes(error), stopped
+
+
+def testcase_result(output, error, stopped, comparator, elapsed):
+    """Turn what capture() read into the result of a test case, as streamed back to the grader."""
+    if stopped == TIMED_OUT:
+        output, error = '', TIMEOUT_ERROR
+    else:
+        output = output.decode('utf-8', 'replace').strip()
+        error = error.decode('utf-8', 'replace').strip()
+        if stopped == OUTPUT_LIMIT:
+            error = OUTPUT_LIMIT_ERROR
+        elif error != "":
+            error = error.split("\n")[-1]
+
+    passed = None
+    if comparator is not None:
+        passed = stopped is None and comparator.finish()
+    return {
+        'output': output,
+        'error': error,
+        'elapsed': elapsed,
+        'timed_out': stopped == TIMED_OUT,
+        'passed': passed,
+        'mismatch_offset': comparator.mismatch_offset if comparator is not None else None
+    }
+
+
+def limit_resources(timeout, memory_limit=None):
+    """Apply the per test case rlimits to the current process."""
+    cpu_seconds = max(1, int(math.ceil(timeout)))
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if memory_limit:
+        memory_bytes = int(memory_limit) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+
+
+def _exec_child(code, input, out_fd, err_fd, timeout, memory_limit):
+    exit_code = 0
+    try:
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        # the protocol pipes live on fd 0 and 1; replace them before any student code runs. The input
+        # goes in a real file on fd 0, as with `python -c`, so sys.stdin.buffer and fd 0 work too; an
+        # unlinked file rather than a pipe, which would block on inputs larger than its buffer
+        with tempfile.TemporaryFile() as input_file:
+            input_file.write(input.encode('utf-8'))
+            input_file.seek(0)
+            os.dup2(input_file.fileno(), 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        os.close(out_fd)
+        os.close(err_fd)
+
+        sys.stdin = open(0, 'r', encoding='utf-8', closefd=False)
+        sys.stdout = io.TextIOWrapper(io.FileIO(1, 'w', closefd=False), encoding='utf-8')
+        sys.stderr = io.TextIOWrapper(io.FileIO(2, 'w', closefd=False), encoding='utf-8')
+        limit_resources(timeout, memory_limit)
+
+        try:
+            exec(code, {'__name__': '__main__', '__builtins__': __builtins__})
+        except SystemExit as exc:
+            if exc.code is not None and exc.code != 0:
+                if not isinstance(exc.code, int):
+                    sys.stderr.write(str(exc.code) + "\n")
+                exit_code = 1
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code)
+
+
+def main():
+    for module in PRELOAD_MODULES:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    # ctrl+c on the grading worker must not take the zygotes down in the middle of a job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        job = read_frame(0)
+        if job is None:
+            # the grader closed our stdin, nothing left to do
+            break
+        for result in run_job(job):
+            write_frame(1, result)
+        write_frame(1, {'done': True})
+
+
+if __name__ == '__main__':
+    main()
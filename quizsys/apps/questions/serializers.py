@@ -57,11 +57,13 @@ class QuestionSerializer(serializers.ModelSerializer):
     pk = serializers.IntegerField(read_only=True)
     tags = TagRelatedField(many=True, required=False)
     number_of_correct_choices = serializers.IntegerField(read_only=True)
+    reference_solution = serializers.CharField(write_only=True, required=False, allow_blank=True)
 
     class Meta:
         model = Question
         fields = ('pk', 'title', 'description', 'type', 'choices', 'answers', 'testcases', 'extra',
-                  'created_at', 'updated_at', 'tags', 'number_of_correct_choices')
+                  'created_at', 'updated_at', 'tags', 'number_of_correct_choices', 'time_limit', 'memory_limit',
+                  'reference_solution')
 
     def create(self, validated_data):
         tags = validated_data.pop('tags', [])
@@ -77,6 +79,8 @@ class QuestionSerializer(serializers.ModelSerializer):
         validated_data.pop('answers', None)
         validated_data.pop('testcases', None)
         tags = validated_data.pop('tags', [])
+        if 'reference_solution' in validated_data:
+            instance.reference_runtime = None
 
         for key, value in validated_data.items():
             setattr(instance, key, value)
@@ -0,0 +1,28 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from quizsys.apps.questions.answer_keys import invalidate_answer_key
+from quizsys.apps.questions.caches import result_cache
+from quizsys.apps.questions.materials import invalidate_grading_material
+from quizsys.apps.questions.models import TestCase, Choice, Answer, Question
+
+
+@receiver(post_save, sender=TestCase)
+@receiver(post_delete, sender=TestCase)
+def invalidate_grading_results(sender, instance, *args, **kwargs):
+    result_cache.invalidate_question(instance.question_id)
+    invalidate_grading_material(instance.question_id)
+    # the reference solution has to be timed again against the new test cases, and bumping
+    # updated_at retires the cached test cases in every process
+    Question.objects.filter(pk=instance.question_id).update(reference_runtime=None, updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def invalidate_answer_keys(sender, instance, *args, **kwargs):
+    invalidate_answer_key(instance.question_id)
+    # other processes hold their answer key under the old updated_at and build a new one
+    Question.objects.filter(pk=instance.question_id).update(updated_at=timezone.now())
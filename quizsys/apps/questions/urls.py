@@ -4,7 +4,8 @@ from quizsys.apps.questions.views import (
     QuestionListCreateAPIView, QuestionRetrieveUpdateDestroyAPIView,
     ChoiceListCreateAPIView, ChoiceUpdateDestroyAPIView,
     AnswerListCreateAPIView, AnswerUpdateDestroyAPIView, TestCaseListCreateAPIView, TestCaseUpdateDestroyAPIView,
-    TagListAPIView, QuestionsListByTagsAPIView, QuestionSampleTestAPIView)
+    TagListAPIView, QuestionsListByTagsAPIView, QuestionSampleTestAPIView, SampleTestJobAPIView,
+    GradingMetricsAPIView)
 
 app_name = 'questions'
 
@@ -26,4 +27,7 @@ urlpatterns = [
     url(r'^tags/?$', TagListAPIView.as_view()),
     # run sample testcases
     url(r'^question/run-sample-test', QuestionSampleTestAPIView.as_view()),
+    url(r'^question/sample-tests/(?P<job_pk>\d+)/?$', SampleTestJobAPIView.as_view()),
+    # grading pipeline metrics
+    url(r'^grading/metrics/?$', GradingMetricsAPIView.as_view()),
 ]
\ No newline at end of file
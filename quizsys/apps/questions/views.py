@@ -1,3 +1,7 @@
+import time
+
+from django.db import transaction
+from django.http import HttpResponse
 from django.db.models import Q, Count
 from rest_framework import generics, status, exceptions
 from rest_framework.pagination import LimitOffsetPagination
@@ -7,12 +11,16 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from quizsys.apps.core.renderers import QuizsysJSONRenderer
-from quizsys.apps.questions.graders import grade_question
-from quizsys.apps.questions.models import Question, Choice, Answer, TestCase, Tag
+from quizsys.apps.questions.models import Question, Choice, Answer, TestCase, Tag, SampleTestJob
 from quizsys.apps.questions.renderers import QuestionJSONRenderer, ChoiceJSONRenderer, AnswerJSONRenderer, \
     TestCaseJSONRenderer, TagJSONRenderer
 from quizsys.apps.questions.serializers import QuestionSerializer, ChoiceSerializer, AnswerSerializer, \
     TestCaseSerializer, TagSerializer
+from quizsys.settings import GRADER_SAMPLE_TEST_MAX_WAIT, GRADER_SAMPLE_TEST_RETRY_AFTER
+from quizsys.task_queue.new_task import run_sample_test_task, grading_metrics
+
+# how often a long-polling request looks at its sample test job again, in seconds
+SAMPLE_TEST_POLL_INTERVAL = 0.25
 
 
 class QuestionListCreateAPIView(generics.ListCreateAPIView):
@@ -221,9 +229,56 @@ class QuestionSampleTestAPIView(APIView):
         except Question.DoesNotExist:
             raise exceptions.NotFound("Question does not exist")
 
-        response = request.data.get("response", "")
-        results = grade_question(question, response, sample_test=True)
+        # student code is never run inside the web request, the task queue worker grades the job
+        job = SampleTestJob.objects.create(question=question, user=request.user,
+                                           response=request.data.get("response", ""))
+        transaction.on_commit(lambda: run_sample_test_task(str(job.pk), job.question_id))
         return Response({
-            'results': results
-        }, status=status.HTTP_200_OK)
+            'job_id': job.pk,
+            'status': job.status
+        }, status=status.HTTP_202_ACCEPTED, headers={'Retry-After': str(GRADER_SAMPLE_TEST_RETRY_AFTER)})
+
+
+class SampleTestJobAPIView(APIView):
+    """
+    Status of a sample test job. With ?wait=<seconds> the request is held until the job is
+    graded or the wait (at most GRADER_SAMPLE_TEST_MAX_WAIT) is over, whichever comes first. The
+    wait is kept short since it holds a web worker; while the job is unfinished, Retry-After tells
+    the client when to poll again.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, job_pk=None):
+        try:
+            job = SampleTestJob.objects.get(pk=job_pk)
+        except SampleTestJob.DoesNotExist:
+            raise exceptions.NotFound("Sample test job does not exist")
+        if job.user_id != request.user.pk and not request.user.is_staff:
+            raise exceptions.PermissionDenied("You can only see your own sample tests")
+
+        try:
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            raise exceptions.ValidationError("wait must be a number of seconds")
+        deadline = time.time() + min(max(wait, 0), GRADER_SAMPLE_TEST_MAX_WAIT)
+        while not job.is_finished and time.time() < deadline:
+            time.sleep(SAMPLE_TEST_POLL_INTERVAL)
+            job.refresh_from_db(fields=['status', 'results'])
+
+        headers = {} if job.is_finished else {'Retry-After': str(GRADER_SAMPLE_TEST_RETRY_AFTER)}
+        return Response({
+            'job_id': job.pk,
+            'status': job.status,
+            'results': job.get_results()
+        }, status=status.HTTP_200_OK, headers=headers)
+
+
+class GradingMetricsAPIView(APIView):
+    """
+    Grading pipeline metrics in the Prometheus text format, see quizsys.apps.core.metrics. A scraper
+    authenticates with the JWT of a staff user; manage.py grading_metrics prints the same text.
+    """
+    permission_classes = (IsAuthenticated, IsAdminUser, )
 
+    def get(self, request):
+        return HttpResponse(grading_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
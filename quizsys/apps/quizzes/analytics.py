@@ -0,0 +1,102 @@
+"""
+Item analysis of quizzes: how hard each question was, how well it told strong students from weak
+ones, and how consistently the quiz as a whole measured them.
+
+The answers of a quiz are read in one query into a students x questions matrix and every statistic
+is computed on whole columns of it with NumPy, so the cost grows with the size of the matrix rather
+than with Python work per answer. Only submissions without pending grades are analysed; a question a
+student did not answer counts as 0 points and not correct. The point-biserial correlation of a
+question is taken against the rest of the score, without the question itself.
+"""
+import numpy
+
+from quizsys.apps.quizzes.grading import get_points
+from quizsys.apps.quizzes.models import QuestionSubmission, ScoreDistribution
+
+# share of the students, ranked by total score, in each of the upper and lower groups of the discrimination index
+DISCRIMINATION_GROUP = 0.27
+
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def load_matrix(quiz, question_pks):
+    """Scores and correctness (1.0 or 0.0) of every graded submission of a quiz, one row per student."""
+    answers = numpy.array(QuestionSubmission.objects
+                          .filter(quiz_submission__quiz=quiz, quiz_submission__pending_grades=0,
+                                  question__in=list(question_pks))
+                          .order_by().values_list('quiz_submission_id', 'question_id', 'score', 'is_correct'),
+                          dtype=float).reshape(-1, 4)
+
+    students, rows = numpy.unique(answers[:, 0], return_inverse=True)
+    columns = numpy.searchsorted(question_pks, answers[:, 1])
+    scores = numpy.zeros((len(students), len(question_pks)))
+    correct = numpy.zeros((len(students), len(question_pks)))
+    scores[rows, columns] = numpy.nan_to_num(answers[:, 2])
+    correct[rows, columns] = numpy.nan_to_num(answers[:, 3])
+    return scores, correct
+
+
+def item_analysis(quiz):
+    questions = dict(ScoreDistribution.objects.filter(quiz=quiz).values_list('question_id', 'question__title'))
+    question_pks = numpy.array(sorted(questions), dtype=int)
+    scores, correct = load_matrix(quiz, question_pks)
+    totals = scores.sum(axis=1)
+
+    if len(totals):
+        difficulty = correct.mean(axis=0)
+        percentiles = numpy.percentile(totals, PERCENTILES)
+    else:
+        difficulty = numpy.full(len(question_pks), numpy.nan)
+        percentiles = [numpy.nan] * len(PERCENTILES)
+    discrimination = discrimination_index(correct, totals)
+    point_biserial = column_correlation(correct, totals[:, None] - scores)
+
+    points = get_points(quiz)
+    return {
+        'students': len(totals),
+        'cronbach_alpha': _float(cronbach_alpha(scores)),
+        'percentiles': {str(percentile): _float(value) for percentile, value in zip(PERCENTILES, percentiles)},
+        'questions': [{
+            'pk': int(pk),
+            'title': questions[int(pk)],
+            'point': points.get(int(pk)),
+            'difficulty': _float(difficulty[index]),
+            'discrimination': _float(discrimination[index]),
+            'point_biserial': _float(point_biserial[index])
+        } for index, pk in enumerate(question_pks)]
+    }
+
+
+def discrimination_index(correct, totals):
+    """Share of the upper group answering each question correctly minus that of the lower group."""
+    group = int(round(len(totals) * DISCRIMINATION_GROUP))
+    if group == 0:
+        return numpy.full(correct.shape[1], numpy.nan)
+    ranked = numpy.argsort(totals, kind='mergesort')
+    return correct[ranked[-group:]].mean(axis=0) - correct[ranked[:group]].mean(axis=0)
+
+
+def column_correlation(x, y):
+    """Pearson correlation of each column of x with the same column of y, NaN where either is constant."""
+    if not len(x):
+        return numpy.full(x.shape[1], numpy.nan)
+    x = x - x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    denominator = numpy.sqrt((x * x).sum(axis=0) * (y * y).sum(axis=0))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(denominator > 0, (x * y).sum(axis=0) / denominator, numpy.nan)
+
+
+def cronbach_alpha(scores):
+    students, items = scores.shape
+    if students < 2 or items < 2:
+        return numpy.nan
+    total_variance = scores.sum(axis=1).var(ddof=1)
+    if total_variance == 0:
+        return numpy.nan
+    return items / (items - 1) * (1 - scores.var(axis=0, ddof=1).sum() / total_variance)
+
+
+def _float(value):
+    # NaN is not valid JSON
+    return None if numpy.isnan(value) else float(value)
@@ -0,0 +1,178 @@
+import json
+
+from django.db import transaction
+from django.db.models import Sum, Count, Min, Max, Q, F
+from django.utils import timezone
+
+from quizsys.apps.core.caches import VersionedCache
+from quizsys.apps.questions.graders import grade_question
+from quizsys.apps.quizzes.models import QuizSubmission, QuestionSubmission, ScoreDistribution, QuizStats
+from quizsys.settings import GRADER_MATERIAL_CACHE_SIZE
+
+# question types cheap enough to grade inside the submission request, the others go to the task queue
+INLINE_QUESTION_TYPES = ('MCQ', 'FIB')
+
+
+def parse_task(body):
+    """
+    Grading tasks are {"quiz_submission": pk} for a whole quiz submission. A bare pk is a single
+    question submission, as queued by the post_save signal and by older versions of the web app.
+    """
+    body = body.decode() if isinstance(body, bytes) else body
+    if body.startswith('{'):
+        return json.loads(body)
+    return {'question_submissions': [int(body)]}
+
+
+def grade_task(task):
+    if 'quiz_submission' in task:
+        # one query for everything not cached: the answers, their questions and the quiz
+        question_submissions = list(QuestionSubmission.objects
+                                    .filter(quiz_submission=task['quiz_submission'], is_graded=False)
+                                    .select_related('question', 'quiz_submission__quiz'))
+        if not question_submissions:
+            # a task delivered again after its grades were recorded; the score may not have been
+            update_score(task['quiz_submission'])
+            return []
+        return grade_question_submissions(question_submissions[0].quiz_submission, question_submissions)
+
+    graded = []
+    question_submissions = QuestionSubmission.objects.filter(pk__in=task['question_submissions'], is_graded=False) \
+        .select_related('question', 'quiz_submission__quiz')
+    for question_submission in question_submissions:
+        graded += grade_question_submissions(question_submission.quiz_submission, [question_submission])
+    return graded
+
+
+def grade_question_submissions(quiz_submission, question_submissions):
+    """
+    Grade question submissions of one quiz submission, looking the points of the quiz up once,
+    and bring the score of the quiz submission up to date. Returns the question submissions whose
+    grade this call recorded.
+
+    Safe to run any number of times and in any number of workers at once: a grade is only
+    recorded on a question submission that is not graded yet, and the quiz submission score is
+    recomputed from the recorded grades rather than incremented.
+    """
+    points = get_points(quiz_submission.quiz)
+
+    graded = []
+    for instance in question_submissions:
+        grade_question_submission(instance, points[instance.question_id])
+        recorded = QuestionSubmission.objects.filter(pk=instance.pk, is_graded=False).update(
+            is_correct=instance.is_correct,
+            score=instance.score,
+            is_graded=True,
+            extra_info=instance.extra_info,
+            updated_at=timezone.now()
+        )
+        if recorded:
+            graded.append(instance)
+
+    update_score(quiz_submission.pk)
+    return graded
+
+
+def grade_question_submission(instance, question_point):
+    """Grade a question submission in place, without saving it. Returns its score."""
+    grading_result = grade_question(instance.question, instance.response)
+    response_correct = grading_result["status"]
+
+    question_score = grading_result.pop('score', response_correct)
+    instance.is_correct = response_correct
+    instance.score = question_point * question_score
+    instance.is_graded = True
+    instance.extra_info = grading_result.pop('extra_info', "")
+    return instance.score
+
+
+def get_points(quiz):
+    """Points of every question of a quiz, by question pk."""
+    return _points.get(quiz)
+
+
+def compile_points(quiz):
+    return dict(ScoreDistribution.objects.filter(quiz=quiz.pk).values_list('question_id', 'point'))
+
+
+def invalidate_points(quiz_pk):
+    _points.invalidate(quiz_pk)
+
+
+_points = VersionedCache(GRADER_MATERIAL_CACHE_SIZE, compile_points)
+
+
+def update_score(quiz_submission_pk):
+    """
+    Set the score of a quiz submission to the sum of the grades recorded on its question
+    submissions, its pending grades to the number of those not graded yet, and bring the stats
+    of its quiz up to date.
+    """
+    with transaction.atomic():
+        # holding the row makes concurrent updates take turns, so the last one sums every grade
+        rows = list(QuizSubmission.objects.select_for_update().filter(pk=quiz_submission_pk)
+                    .values_list('quiz_id', 'pending_grades', 'counted_score'))
+        if not rows:
+            # deleted along with its question submissions
+            return
+        quiz_pk, pending_grades, counted_score = rows[0]
+        totals = QuestionSubmission.objects.filter(quiz_submission=quiz_submission_pk).aggregate(
+            score=Sum('score', filter=Q(is_graded=True)),
+            pending_grades=Count('pk', filter=Q(is_graded=False))
+        )
+        score = totals['score'] or 0
+        counted_score = update_quiz_stats(quiz_pk, quiz_submission_pk, pending_grades > 0,
+                                          totals['pending_grades'] > 0, counted_score, score)
+        QuizSubmission.objects.filter(pk=quiz_submission_pk).update(
+            score=score, pending_grades=totals['pending_grades'], counted_score=counted_score)
+        # committed along with the grades, unlike a timestamp taken before the commit (see reports.py)
+        QuizStats.objects.filter(quiz=quiz_pk).update(version=F('version') + 1)
+
+
+def update_quiz_stats(quiz_pk, quiz_submission_pk, was_pending, is_pending, counted_score, score):
+    """
+    Account for a change of a quiz submission in the stats of its quiz, without reading the other
+    submissions unless it held the lowest or highest score. A submission is counted with its score
+    once it has no pending grades, and keeps the score it was counted with while it is regraded.
+    Returns the score it is counted with now, to be saved as its counted_score.
+
+    The caller holds the lock of the quiz submission; the stats row is locked after it and until
+    the transaction ends, so it is best called last.
+    """
+    new_counted_score = counted_score if is_pending else score
+    if was_pending == is_pending and new_counted_score == counted_score:
+        return counted_score
+
+    stats, _ = QuizStats.objects.select_for_update(of=('self',)).select_related('quiz').get_or_create(quiz_id=quiz_pk)
+    stats.pending += int(is_pending) - int(was_pending)
+    stats.version += 1
+    if new_counted_score != counted_score:
+        extremes_kept = True
+        if counted_score is not None:
+            extremes_kept = stats.remove(counted_score)
+        if not extremes_kept:
+            extremes = QuizSubmission.objects.filter(quiz=quiz_pk, counted_score__isnull=False) \
+                .exclude(pk=quiz_submission_pk).aggregate(min_score=Min('counted_score'), max_score=Max('counted_score'))
+            stats.min_score, stats.max_score = extremes['min_score'], extremes['max_score']
+        if new_counted_score is not None:
+            stats.add(new_counted_score)
+    stats.save()
+    return new_counted_score
+
+
+def rebuild_quiz_stats(quiz):
+    """Recompute the stats of a quiz from all its submissions, e.g. after its points or pass score change."""
+    with transaction.atomic():
+        quiz_submissions = QuizSubmission.objects.filter(quiz=quiz)
+        # submissions before stats, the order update_score takes them in, so the two never deadlock
+        list(quiz_submissions.select_for_update().order_by('pk').values_list('pk'))
+        quiz_submissions.filter(pending_grades=0).update(counted_score=F('score'))
+        stats, _ = QuizStats.objects.select_for_update().get_or_create(quiz=quiz)
+
+        stats = QuizStats(pk=stats.pk, quiz=quiz, created_at=stats.created_at, version=stats.version + 1)
+        for counted_score in quiz_submissions.filter(counted_score__isnull=False) \
+                .values_list('counted_score', flat=True).iterator():
+            stats.add(counted_score)
+        stats.pending = quiz_submissions.filter(pending_grades__gt=0).count()
+        stats.save()
+        return stats
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from quizsys.task_queue.new_task import grading_metrics
+
+
+class Command(BaseCommand):
+    help = 'Print the grading pipeline metrics of every grading process, in the Prometheus text format'
+
+    def handle(self, *args, **options):
+        self.stdout.write(grading_metrics(), ending='')
@@ -0,0 +1,106 @@
+import os
+import signal
+import sys
+import time
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from quizsys.settings import GRADER_WORKER_PROCESSES, GRADER_WORKER_PREFETCH, GRADER_WORKER_MAX_JOBS, \
+    GRADER_WORKER_MAX_MEMORY, GRADER_LANE_WEIGHTS
+from quizsys.task_queue.consumer import Consumer, parse_lanes
+
+# a worker that dies sooner than this after starting is restarted only after the backoff, in seconds
+MIN_UPTIME = 5
+RESTART_BACKOFF = 5
+
+
+class Command(BaseCommand):
+    help = 'Grade quiz submissions and sample tests with a supervised group of task queue consumers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=GRADER_WORKER_PROCESSES)
+        parser.add_argument('--prefetch', type=int, default=GRADER_WORKER_PREFETCH)
+        parser.add_argument('--max-jobs', type=int, default=GRADER_WORKER_MAX_JOBS,
+                            help='replace a worker after this many tasks, 0 for never')
+        parser.add_argument('--max-memory', type=int, default=GRADER_WORKER_MAX_MEMORY,
+                            help='replace a worker once it has used this many MB, 0 for never')
+        parser.add_argument('--lanes', default=GRADER_LANE_WEIGHTS,
+                            help='lanes to grade and their weights, e.g. interactive:1 for sample tests only')
+
+    def handle(self, *args, **options):
+        try:
+            parse_lanes(options['lanes'])
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.options = options
+        self.stopping = False
+        self.workers = {}
+
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        # every worker opens its own database connection
+        connections.close_all()
+
+        for slot in range(options['processes']):
+            self.spawn(slot)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self.workers:
+                continue
+            slot, started = self.workers.pop(pid)
+            if self.stopping:
+                continue
+
+            uptime = time.time() - started
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                self.stdout.write("Worker %d (pid %d) retired after %.0f s" % (slot, pid, uptime))
+            else:
+                self.stderr.write("Worker %d (pid %d) died after %.0f s with status %d" % (slot, pid, uptime, status))
+                if uptime < MIN_UPTIME:
+                    time.sleep(RESTART_BACKOFF)
+            if not self.stopping:
+                self.spawn(slot)
+
+        self.stdout.write("All workers stopped")
+
+    def spawn(self, slot):
+        # held back until the new worker is either known to us or has its own handlers
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+        pid = os.fork()
+        if pid == 0:
+            # the supervisor turns ctrl+c into a SIGTERM to every worker
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+            exit_code = 0
+            try:
+                Consumer(self.options['prefetch'], self.options['max_jobs'], self.options['max_memory'],
+                         lanes=self.options['lanes']).run()
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        self.workers[pid] = (slot, time.time())
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+        self.stdout.write("Worker %d started (pid %d)" % (slot, pid))
+
+    def shutdown(self, *args):
+        """Let every worker finish the task in hand, then exit."""
+        if not self.stopping:
+            self.stdout.write("Stopping workers after their current tasks")
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from quizsys.apps.quizzes.grading import rebuild_quiz_stats
+from quizsys.apps.quizzes.models import Quiz, QuizSubmission
+
+
+class Command(BaseCommand):
+    help = 'Recompute the counters stored on quizzes and quiz submissions, and the score stats of quizzes'
+
+    def handle(self, *args, **options):
+        updated = Quiz.objects.all().refresh_counters()
+        self.stdout.write("Rebuilt the counters of %d quizzes" % updated)
+        updated = QuizSubmission.objects.all().refresh_pending_grades()
+        self.stdout.write("Rebuilt the pending grades of %d quiz submissions" % updated)
+        quizzes = list(Quiz.objects.all())
+        for quiz in quizzes:
+            rebuild_quiz_stats(quiz)
+        self.stdout.write("Rebuilt the stats of %d quizzes" % len(quizzes))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from quizsys.apps.quizzes.grading import rebuild_quiz_stats
+from quizsys.apps.quizzes.models import Quiz, QuestionSubmission, QuizSubmission
+from quizsys.task_queue.new_task import regrade_quiz_submission_task
+
+
+class Command(BaseCommand):
+    help = 'Grade the submissions of a quiz again, in the regrade lane of the grading workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('quiz', type=int)
+        parser.add_argument('--question', type=int, help='only regrade the answers to this question')
+
+    def handle(self, *args, **options):
+        try:
+            quiz = Quiz.objects.get(pk=options['quiz'])
+        except Quiz.DoesNotExist:
+            raise CommandError("Quiz does not exist")
+
+        question_submissions = QuestionSubmission.objects.filter(quiz_submission__quiz=quiz)
+        if options['question'] is not None:
+            question_submissions = question_submissions.filter(question=options['question'])
+
+        with transaction.atomic():
+            # each quiz submission goes to the grading host of one of the questions it is regraded for
+            questions = dict(question_submissions.values_list('quiz_submission_id', 'question_id'))
+            # the workers only grade what is not graded; scores are summed again from the new grades
+            question_submissions.update(is_graded=False, updated_at=timezone.now())
+            QuizSubmission.objects.filter(pk__in=list(questions)).refresh_pending_grades()
+            # regraded submissions keep their old score in the stats until they are graded again
+            rebuild_quiz_stats(quiz)
+            transaction.on_commit(lambda: self.queue(questions))
+
+        self.stdout.write("Queued %d quiz submissions of %s for regrading" % (len(questions), quiz.title))
+
+    def queue(self, questions):
+        for pk in sorted(questions):
+            regrade_quiz_submission_task(pk, questions[pk])
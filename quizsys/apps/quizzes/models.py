@@ -1,10 +1,33 @@
+import json
+import math
+
 from django.db import models
+from django.db.models import OuterRef, Subquery, Count, Sum
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from quizsys.apps.core.models import TimestampedModel
 from quizsys.apps.users.models import User
 
 
+class QuizQuerySet(models.QuerySet):
+
+    def refresh_counters(self, **fields):
+        """
+        Recompute number_of_questions and total_points of these quizzes from their score
+        distributions, in one UPDATE that also sets any other fields given.
+        """
+        # order_by() keeps the default ordering out of the GROUP BY
+        score_distributions = ScoreDistribution.objects.filter(quiz=OuterRef('pk')).order_by().values('quiz')
+        return self.update(
+            number_of_questions=Coalesce(Subquery(score_distributions.annotate(count=Count('pk')).values('count'),
+                                                  output_field=models.IntegerField()), 0),
+            total_points=Subquery(score_distributions.annotate(total=Sum('point')).values('total'),
+                                  output_field=models.FloatField()),
+            **fields
+        )
+
+
 class Quiz(TimestampedModel):
     start_time = models.DateTimeField()
     end_time = models.DateTimeField()
@@ -15,26 +38,29 @@ class Quiz(TimestampedModel):
     labgroup = models.ForeignKey('users.Group', on_delete=models.SET_NULL, related_name='quizzes', null=True)
     pass_score = models.FloatField(default=0)
     push_notification = models.NullBooleanField(default=True, null=True)
+    # kept up to date from the score distributions (see signals.py), rebuilt by manage.py rebuild_quiz_counters
+    number_of_questions = models.PositiveIntegerField(default=0)
+    total_points = models.FloatField(null=True, blank=True) # empty while the quiz has no question
+
+    objects = QuizQuerySet.as_manager()
 
     class Meta:
         verbose_name_plural = 'quizzes'
         ordering = ['-start_time']
 
-    @property
-    def number_of_questions(self):
-        return self.score_distributions.count()
-
-    @property
-    def total_points(self):
-        return self.score_distributions.aggregate(models.Sum('point'))['point__sum']
-
     @property
     def average_scores(self):
-        quiz_submissions = self.quiz_submissions
-        for quiz_submission in quiz_submissions.all():
-            if not quiz_submission.is_graded:
-                return "Grading in progress..."
-        return str(quiz_submissions.aggregate(models.Avg('score'))['score__avg'])
+        stats = self.get_stats()
+        if stats.pending:
+            return "Grading in progress..."
+        return str(stats.average)
+
+    def get_stats(self):
+        try:
+            return self.stats
+        except QuizStats.DoesNotExist:
+            # a quiz without any submission yet
+            return QuizStats(quiz=self)
 
     @property
     def quiz_status(self):
@@ -53,17 +79,113 @@ class ScoreDistribution(TimestampedModel):
     point = models.FloatField() # used for grading
 
 
+class QuizSubmissionQuerySet(models.QuerySet):
+
+    def refresh_pending_grades(self, **fields):
+        """
+        Recount the ungraded question submissions of these quiz submissions, in one UPDATE that
+        also sets any other fields given.
+        """
+        # order_by() keeps the default ordering out of the GROUP BY
+        pending = QuestionSubmission.objects.filter(quiz_submission=OuterRef('pk'), is_graded=False).order_by() \
+            .values('quiz_submission').annotate(count=Count('pk')).values('count')
+        return self.update(pending_grades=Coalesce(Subquery(pending, output_field=models.IntegerField()), 0),
+                           **fields)
+
+
 class QuizSubmission(TimestampedModel):
     quiz = models.ForeignKey(Quiz, on_delete=models.CASCADE, related_name='quiz_submissions')
     user = models.ForeignKey('users.User', on_delete=models.CASCADE, related_name='quiz_submissions')
     score = models.FloatField(default=0)
+    # question submissions not graded yet, counted again whenever one is created or graded
+    pending_grades = models.PositiveIntegerField(default=0)
+    # the score this submission is counted with in the stats of its quiz, empty until it is first graded
+    counted_score = models.FloatField(null=True, blank=True)
+
+    objects = QuizSubmissionQuerySet.as_manager()
+
+    class Meta(TimestampedModel.Meta):
+        indexes = [models.Index(fields=['quiz', 'pending_grades'])]
 
     @property
     def is_graded(self):
-        for question_submission in self.question_submissions.all():
-            if not question_submission.is_graded:
-                return False
-        return True
+        return self.pending_grades == 0
+
+
+# histogram bins of QuizStats, evenly spread between 0 and the total points of the quiz
+STATS_BINS = 10
+
+
+# score statistics of the graded submissions of a quiz, updated one submission at a time
+# (see quizsys.apps.quizzes.grading.update_quiz_stats) and rebuilt by manage.py rebuild_quiz_counters
+class QuizStats(TimestampedModel):
+    quiz = models.OneToOneField(Quiz, on_delete=models.CASCADE, related_name='stats')
+    count = models.PositiveIntegerField(default=0)
+    total = models.FloatField(default=0)
+    total_squares = models.FloatField(default=0)
+    min_score = models.FloatField(null=True, blank=True)
+    max_score = models.FloatField(null=True, blank=True)
+    pass_count = models.PositiveIntegerField(default=0)
+    histogram = models.TextField(default="") # json list of STATS_BINS counts
+    pending = models.PositiveIntegerField(default=0) # submissions still waiting for grades
+    # bumped with every grade recorded for the quiz, in the same transaction; versions its cached reports
+    version = models.PositiveIntegerField(default=0)
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def standard_deviation(self):
+        if not self.count:
+            return None
+        # rounding can take the variance of equal scores slightly below 0
+        return math.sqrt(max(self.total_squares / self.count - self.average ** 2, 0))
+
+    def get_histogram(self):
+        return json.loads(self.histogram) if self.histogram else [0] * STATS_BINS
+
+    def bin(self, score):
+        total_points = self.quiz.total_points
+        if not total_points:
+            return 0
+        return min(max(int(score * STATS_BINS / total_points), 0), STATS_BINS - 1)
+
+    def add(self, score):
+        histogram = self.get_histogram()
+        histogram[self.bin(score)] += 1
+        self.histogram = json.dumps(histogram)
+        self.count += 1
+        self.total += score
+        self.total_squares += score * score
+        self.min_score = score if self.min_score is None else min(self.min_score, score)
+        self.max_score = score if self.max_score is None else max(self.max_score, score)
+        if score >= self.quiz.pass_score:
+            self.pass_count += 1
+
+    def remove(self, score):
+        """Take a score out. Returns False if it was the min or max, which then have to be looked up again."""
+        histogram = self.get_histogram()
+        histogram[self.bin(score)] = max(histogram[self.bin(score)] - 1, 0)
+        self.histogram = json.dumps(histogram)
+        self.count -= 1
+        self.total -= score
+        self.total_squares -= score * score
+        if score >= self.quiz.pass_score:
+            self.pass_count -= 1
+        return score != self.min_score and score != self.max_score
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'average': self.average,
+            'standard_deviation': self.standard_deviation,
+            'min': self.min_score,
+            'max': self.max_score,
+            'pass_count': self.pass_count,
+            'histogram': self.get_histogram(),
+            'pending': self.pending
+        }
 
 
 class QuestionSubmission(TimestampedModel):
@@ -85,3 +207,18 @@ class Announcement(TimestampedModel):
     def __str__(self):
         return self.content + " - " + self.user.username
 
+
+# task of the grading queue, when GRADER_QUEUE_BACKEND is 'database'
+class GradingJob(TimestampedModel):
+    queue = models.CharField(max_length=255, db_index=True)
+    body = models.TextField()
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=255, blank=True) # host:pid of the worker grading it
+    attempts = models.PositiveIntegerField(default=0) # times it raised in a worker before
+
+
+# grading host taking the tasks of some questions in its own queues, see quizsys.task_queue.routing
+class GradingNode(TimestampedModel):
+    name = models.CharField(max_length=100, unique=True)
+    heartbeat_at = models.DateTimeField()
+    backlog = models.PositiveIntegerField(default=0) # tasks waiting in its own queues at the last heartbeat
@@ -0,0 +1,54 @@
+from django.db.models import Count, Q
+
+from quizsys.apps.core.caches import LRUCache
+from quizsys.apps.quizzes.models import QuizSubmission, QuestionSubmission, ScoreDistribution
+from quizsys.settings import QUIZ_REPORT_CACHE_SIZE
+
+_reports = LRUCache(QUIZ_REPORT_CACHE_SIZE)
+
+
+def get_quiz_report(quiz):
+    """
+    Scores of every submission of a quiz and the share of correct answers to each of its questions.
+    The part read from the submissions is kept in this process, versioned by QuizStats.version,
+    which every grade recorded, deleted submission, regrade and point change bumps in its own
+    transaction. The version is read before the submissions, so a cached report is never older
+    than its version.
+    """
+    stats = quiz.get_stats()
+    version = (quiz.pk, quiz.updated_at.isoformat(), stats.version)
+    graded = _reports.get(version) if stats.pk is not None else None
+    if graded is None:
+        graded = aggregate_quiz_report(quiz)
+        if stats.pk is not None:
+            # a quiz without stats yet has no version to go by
+            _reports.set(version, graded)
+    scores, correct_rates = graded
+
+    questions = []
+    for score_distribution in ScoreDistribution.objects.filter(quiz=quiz).select_related('question') \
+            .prefetch_related('question__tags'):
+        question = score_distribution.question
+        questions.append({
+            'pk': question.pk,
+            'title': question.title,
+            'tags': [tag.content for tag in question.tags.all()],
+            'type': question.type,
+            # a question nobody answered has no correct answers
+            'percentage': correct_rates.get(question.pk, 0)
+        })
+    return {
+        'scores': scores,
+        'questions': questions,
+        'statistics': stats.as_dict()
+    }
+
+
+def aggregate_quiz_report(quiz):
+    """The sorted [score, username] of every submission, and the percentage of correct answers by question pk."""
+    scores = sorted([list(row) for row in QuizSubmission.objects.filter(quiz=quiz).order_by()
+                     .values_list('score', 'user__username')])
+    answers = QuestionSubmission.objects.filter(quiz_submission__quiz=quiz).order_by().values('question') \
+        .annotate(answered=Count('pk'), correct=Count('pk', filter=Q(is_correct=True)))
+    correct_rates = {answer['question']: answer['correct'] / answer['answered'] * 100 for answer in answers}
+    return scores, correct_rates
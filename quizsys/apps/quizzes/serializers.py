@@ -1,11 +1,15 @@
 from dateutil import tz
+from django.db import transaction
 from rest_framework import serializers
 
 from quizsys.apps.core.relations import CustomizedDateTimeField
 from quizsys.apps.questions.models import Question
+from quizsys.apps.quizzes.grading import INLINE_QUESTION_TYPES, grade_question_submission, get_points, \
+    update_quiz_stats, rebuild_quiz_stats
 from quizsys.apps.quizzes.models import Quiz, ScoreDistribution, QuestionSubmission, QuizSubmission, Announcement
 from quizsys.apps.quizzes.relations import QuestionRelatedField, QuizRelatedField
 from quizsys.apps.users.relations import UserRelatedField, GroupRelatedField
+from quizsys.task_queue.new_task import grade_quiz_submission_task
 
 
 class ScoreDistributionSerializer(serializers.ModelSerializer):
@@ -39,11 +43,13 @@ class QuizSerializer(serializers.ModelSerializer):
     end_time = CustomizedDateTimeField()
     answer_release_time = CustomizedDateTimeField()
     quiz_status = serializers.CharField(max_length=20, read_only=True)
+    statistics = serializers.DictField(source='get_stats.as_dict', read_only=True)
 
     class Meta:
         model = Quiz
         fields = ('pk', 'start_time', 'end_time', 'answer_release_time', 'description', 'title', 'quiz_status',
-                  'labgroup', 'questions_per_page', 'number_of_questions', 'total_points', 'pass_score', 'push_notification')
+                  'labgroup', 'questions_per_page', 'number_of_questions', 'total_points', 'pass_score', 'push_notification',
+                  'statistics')
 
     def create(self, validated_data):
         score_distributions = validated_data.pop('score_distributions', [])
@@ -56,10 +62,13 @@ class QuizSerializer(serializers.ModelSerializer):
 
     def update(self, instance, validated_data):
         score_distributions = validated_data.pop('score_distributions', [])
+        pass_score = instance.pass_score
 
         for key, value in validated_data.items():
             setattr(instance, key, value)
         instance.save()
+        if instance.pass_score != pass_score:
+            rebuild_quiz_stats(instance)
 
         score_distributions_queryset = instance.score_distributions
         for score_distribution in score_distributions:
@@ -102,14 +111,44 @@ class QuizSubmissionSerializer(serializers.ModelSerializer):
         fields = ('pk', 'quiz', 'user', 'score', 'question_submissions', 'is_graded', 'average_scores',
                   'pass_score')
 
+    def validate_question_submissions(self, question_submissions):
+        # answers are graded against the points of the quiz, which only its own questions have
+        points = get_points(self.context['quiz'])
+        for question_submission in question_submissions:
+            if question_submission['question'].pk not in points:
+                raise serializers.ValidationError("Question %d is not in this quiz" % question_submission['question'].pk)
+        return question_submissions
+
     def create(self, validated_data):
         user = self.context['user']
         quiz = self.context['quiz']
-        question_submissions = validated_data.pop('question_submissions', [])
-        quiz_submission = QuizSubmission.objects.create(user=user, quiz=quiz, **validated_data)
+        question_submissions = [QuestionSubmission(**question_submission)
+                                for question_submission in validated_data.pop('question_submissions', [])]
 
+        # objective questions are graded right away, so the quiz submission starts with their score
+        # and only coding questions wait for the task queue
+        points = get_points(quiz)
+        inline_score = 0
         for question_submission in question_submissions:
-            QuestionSubmission.objects.create(quiz_submission=quiz_submission, **question_submission)
+            if question_submission.question.type in INLINE_QUESTION_TYPES:
+                inline_score += grade_question_submission(question_submission, points[question_submission.question_id])
+
+        ungraded = [question_submission.question_id for question_submission in question_submissions
+                    if not question_submission.is_graded]
+        with transaction.atomic():
+            quiz_submission = QuizSubmission.objects.create(user=user, quiz=quiz, score=inline_score,
+                                                            pending_grades=len(ungraded),
+                                                            counted_score=None if ungraded else inline_score,
+                                                            **validated_data)
+            for question_submission in question_submissions:
+                question_submission.quiz_submission = quiz_submission
+            QuestionSubmission.objects.bulk_create(question_submissions)
+            # last, every submission to the quiz waits on the lock of its stats until this commits
+            update_quiz_stats(quiz.pk, quiz_submission.pk, False, bool(ungraded), None, inline_score)
+            # one task for the rest of the submission, sent once the worker can see every row of it,
+            # to the grading host of its first ungraded question
+            if ungraded:
+                transaction.on_commit(lambda: grade_quiz_submission_task(quiz_submission.pk, ungraded[0]))
 
         if quiz_submission.is_graded and quiz_submission.quiz.push_notification and quiz_submission.score < quiz_submission.quiz.pass_score:
             content = "You did not score enough to pass the quiz '%s'. All the best for the next quiz."
@@ -1,13 +1,56 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
-from quizsys.apps.quizzes.models import QuestionSubmission
-from quizsys.task_queue.new_task import grade_quiz_submission_task
+from quizsys.apps.quizzes.grading import invalidate_points, update_score, update_quiz_stats, rebuild_quiz_stats
+from quizsys.apps.quizzes.models import QuestionSubmission, ScoreDistribution, Quiz, QuizSubmission, QuizStats
+from quizsys.task_queue.new_task import grade_question_submission_task
 
 
+# question submissions of a quiz submission are bulk created, counted and queued as one task by
+# QuizSubmissionSerializer; these only catch the ones saved or deleted one by one
 @receiver(post_save, sender=QuestionSubmission)
 def grade_and_update_quiz_score(sender, instance, created, *args, **kwargs):
+    update_score(instance.quiz_submission_id)
     if instance.is_graded:
         return
 
-    grade_quiz_submission_task(str(instance.pk))
+    # the worker must not look for the row before it is committed
+    transaction.on_commit(lambda: grade_question_submission_task(str(instance.pk), instance.question_id))
+
+
+@receiver(post_delete, sender=QuestionSubmission)
+def update_pending_grades(sender, instance, *args, **kwargs):
+    # not update_score: this also runs for every answer of a quiz submission being deleted, whose
+    # score already left the stats in remove_from_quiz_stats
+    QuizSubmission.objects.filter(pk=instance.quiz_submission_id).refresh_pending_grades()
+
+
+@receiver(pre_delete, sender=QuizSubmission)
+def remove_from_quiz_stats(sender, instance, *args, **kwargs):
+    with transaction.atomic():
+        rows = list(QuizSubmission.objects.select_for_update().filter(pk=instance.pk)
+                    .values_list('pending_grades', 'counted_score'))
+        if rows and QuizStats.objects.filter(quiz=instance.quiz_id).exists():
+            pending_grades, counted_score = rows[0]
+            update_quiz_stats(instance.quiz_id, instance.pk, pending_grades > 0, False, counted_score, None)
+
+
+@receiver(post_save, sender=Quiz)
+def create_quiz_stats(sender, instance, created, *args, **kwargs):
+    if created:
+        QuizStats.objects.create(quiz=instance)
+
+
+@receiver(post_save, sender=ScoreDistribution)
+@receiver(post_delete, sender=ScoreDistribution)
+def update_quiz_points(sender, instance, *args, **kwargs):
+    invalidate_points(instance.quiz_id)
+    # a new updated_at is a new version of the points cached by every process, see VersionedCache
+    Quiz.objects.filter(pk=instance.quiz_id).refresh_counters(updated_at=timezone.now())
+    # histogram bins follow the total points; a quiz without stats is being deleted or waits for
+    # manage.py rebuild_quiz_counters
+    stats = QuizStats.objects.filter(quiz=instance.quiz_id).select_related('quiz').first()
+    if stats is not None:
+        rebuild_quiz_stats(stats.quiz)
@@ -3,7 +3,8 @@ from django.conf.urls import url
 from quizsys.apps.quizzes.views import QuizListCreateAPIView, QuizRetrieveUpdateDestroyAPIView, \
     QuizSubmissionListCreateAPIView, QuizSubmissionRetrieveAPIView, ScoreDistributionListCreateAPIView, \
     ScoreDistributionDestroyAPIView, QuizQuestionsListAPIView, QuizSubmissionAllListAPIView, QuizFilteredListAPIView, \
-    SendEmailAPIView, QuizFailedUsersAPIView, AnnouncementListAPIView, QuizReportAPIView
+    SendEmailAPIView, QuizFailedUsersAPIView, AnnouncementListAPIView, QuizReportAPIView, \
+    QuizItemAnalysisAPIView
 
 app_name = 'quizzes'
 
@@ -14,6 +15,7 @@ urlpatterns = {
     url(r'^quiz/(?P<quiz_pk>\d+)/score-distributions/(?P<score_pk>\d+)/?$', ScoreDistributionDestroyAPIView.as_view()),
     url(r'^quiz/(?P<quiz_pk>\d+)/questions/?$', QuizQuestionsListAPIView.as_view()),
     url(r'^quiz-report/(?P<quiz_title>[\w\s]+)/?$', QuizReportAPIView.as_view()),
+    url(r'^quiz-analysis/(?P<quiz_title>[\w\s]+)/?$', QuizItemAnalysisAPIView.as_view()),
 
     url(r'^quiz/(?P<quiz_pk>\d+)/quiz-submissions/?$', QuizSubmissionListCreateAPIView.as_view()),
     url(r'^quiz-submissions/(?P<quiz_submission_pk>\d+)/?$', QuizSubmissionRetrieveAPIView.as_view()),
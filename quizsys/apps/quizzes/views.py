@@ -14,9 +14,11 @@ from rest_framework.views import APIView
 from quizsys.apps.questions.models import Question
 from quizsys.apps.questions.renderers import QuestionJSONRenderer, QuestionAllJSONRenderer
 from quizsys.apps.questions.serializers import QuestionSerializer
-from quizsys.apps.quizzes.models import Quiz, QuizSubmission, ScoreDistribution, Announcement, QuestionSubmission
+from quizsys.apps.quizzes.analytics import item_analysis
+from quizsys.apps.quizzes.models import Quiz, QuizSubmission, ScoreDistribution, Announcement
 from quizsys.apps.quizzes.renderers import QuizJSONRenderer, QuizSubmissionJSONRenderer, ScoreDistributionJSONRenderer, \
     AnnouncementJSONRenderer
+from quizsys.apps.quizzes.reports import get_quiz_report
 from quizsys.apps.quizzes.serializers import QuizSerializer, QuizSubmissionSerializer, ScoreDistributionSerializer, \
     AnnouncementSerializer
 from quizsys.apps.users.models import User
@@ -31,8 +33,8 @@ class QuizListCreateAPIView(generics.ListCreateAPIView):
 
     def get_queryset(self):
         if self.request.user.is_staff:
-            return Quiz.objects.all()
-        return self.request.user.group.quizzes.all()
+            return Quiz.objects.select_related('labgroup', 'stats')
+        return self.request.user.group.quizzes.select_related('labgroup', 'stats')
 
     def create(self, request, *args, **kwargs):
         if not request.user.is_staff:
@@ -245,8 +247,8 @@ class QuizSubmissionListCreateAPIView(generics.ListCreateAPIView):
             raise exceptions.NotFound("Quiz does not exist")
 
         if self.request.user.is_staff:
-            return QuizSubmission.objects.filter(quiz=quiz)
-        return QuizSubmission.objects.filter(quiz=quiz, user=self.request.user)
+            return QuizSubmission.objects.filter(quiz=quiz).select_related('quiz__stats')
+        return QuizSubmission.objects.filter(quiz=quiz, user=self.request.user).select_related('quiz__stats')
 
     def create(self, request, quiz_pk=None):
         try:
@@ -323,8 +325,8 @@ class QuizSubmissionAllListAPIView(generics.ListAPIView):
 
     def get_queryset(self):
         if self.request.user.is_staff:
-            return QuizSubmission.objects.all()
-        return self.request.user.quiz_submissions.all()
+            return QuizSubmission.objects.select_related('quiz__stats')
+        return self.request.user.quiz_submissions.select_related('quiz__stats')
 
     def list(self, request, *args, **kwargs):
         page = self.paginate_queryset(self.get_queryset())
@@ -401,28 +403,21 @@ class QuizReportAPIView(APIView):
     permission_classes = (IsAuthenticated, IsAdminUser,)
     renderer_classes = (QuizJSONRenderer,)
 
+    def get(self, request, quiz_title=None):
+        try:
+            quiz = Quiz.objects.select_related('stats').get(title=quiz_title)
+        except Quiz.DoesNotExist:
+            raise exceptions.NotFound("Quiz does not exist")
+        return Response(get_quiz_report(quiz), status=status.HTTP_200_OK)
+
+
+class QuizItemAnalysisAPIView(APIView):
+    permission_classes = (IsAuthenticated, IsAdminUser,)
+    renderer_classes = (QuizJSONRenderer,)
+
     def get(self, request, quiz_title=None):
         try:
             quiz = Quiz.objects.get(title=quiz_title)
         except Quiz.DoesNotExist:
             raise exceptions.NotFound("Quiz does not exist")
-        quiz_submissions_score = [[
-            quiz_submission.score,
-            quiz_submission.user.username
-        ] for quiz_submission in QuizSubmission.objects.filter(quiz=quiz)]
-        questions = [score_dist.question for score_dist in ScoreDistribution.objects.filter(quiz=quiz)]
-
-        question_submissions = []
-        for question in questions:
-            submissions = QuestionSubmission.objects.filter(question=question, quiz_submission__quiz=quiz)
-            question_submissions.append({
-                'pk': question.pk,
-                'title': question.title,
-                'tags': [tag.content for tag in question.tags.all()],
-                'type': question.type,
-                'percentage': submissions.filter(is_correct=True).count() / submissions.count() * 100
-            })
-        return Response({
-            'scores': sorted(quiz_submissions_score),
-            'questions': question_submissions
-        }, status=status.HTTP_200_OK)
+        return Response(item_analysis(quiz), status=status.HTTP_200_OK)
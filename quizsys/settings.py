@@ -11,11 +11,12 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+import socket
+import tempfile
 from decouple import config
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-CODE_PATH = os.path.join(BASE_DIR, 'scripts')
 
 
 # Quick-start development settings - unsuitable for production
@@ -149,3 +150,60 @@ EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = config('EMAIL_PORT')
 EMAIL_USE_TLS = True
+
+# Grading task queue: 'pika' (RabbitMQ at BROKER_HOST), 'database' or 'memory' (single process only)
+GRADER_QUEUE_BACKEND = config('GRADER_QUEUE_BACKEND', default='pika')
+BROKER_HOST = config('BROKER_HOST', default='localhost')
+# a job of the database queue claimed longer ago than this (in seconds) is handed to another worker
+GRADER_JOB_CLAIM_TIMEOUT = config('GRADER_JOB_CLAIM_TIMEOUT', default=900, cast=int)
+# a grading task that raised this many times is set aside in the dead letter queue of its lane
+GRADER_TASK_MAX_ATTEMPTS = config('GRADER_TASK_MAX_ATTEMPTS', default=3, cast=int)
+# route grading tasks to the grading host that owns their question, by consistent hashing on its pk
+GRADER_NODE_AFFINITY = config('GRADER_NODE_AFFINITY', default=True, cast=bool)
+GRADER_NODE_NAME = config('GRADER_NODE_NAME', default=socket.gethostname())
+# a grading host that has not checked in for this long is left out and its queues handed over, in seconds
+GRADER_NODE_TTL = config('GRADER_NODE_TTL', default=30, cast=int)
+# a grading host with more tasks than this waiting in its own queues gets no more, they go to the shared queues
+GRADER_NODE_MAX_BACKLOG = config('GRADER_NODE_MAX_BACKLOG', default=50, cast=int)
+
+# Coding question grading
+# number of warm sandbox interpreters per grading process, 0 spawns a fresh interpreter per test case
+GRADER_POOL_SIZE = config('GRADER_POOL_SIZE', default=4, cast=int)
+# a sandbox interpreter is replaced after running this many jobs
+GRADER_MAX_JOBS_PER_CHILD = config('GRADER_MAX_JOBS_PER_CHILD', default=200, cast=int)
+# test cases of one submission are spread over at most this many sandbox interpreters at once
+GRADER_SUBMISSION_CONCURRENCY = config('GRADER_SUBMISSION_CONCURRENCY', default=2, cast=int)
+# sandbox jobs running at the same time on this host, across every grading process
+GRADER_HOST_CONCURRENCY = config('GRADER_HOST_CONCURRENCY', default=os.cpu_count() or 1, cast=int)
+GRADER_LOCK_PATH = config('GRADER_LOCK_PATH', default=os.path.join(tempfile.gettempdir(), 'quizsys-grader'))
+# grading results of identical coding submissions kept per process
+GRADER_RESULT_CACHE_SIZE = config('GRADER_RESULT_CACHE_SIZE', default=1024, cast=int)
+# compiled MCQ/FIB answer keys kept per process
+GRADER_ANSWER_KEY_CACHE_SIZE = config('GRADER_ANSWER_KEY_CACHE_SIZE', default=4096, cast=int)
+# test cases and fill-in templates of coding questions, and points of quizzes, kept per process
+GRADER_MATERIAL_CACHE_SIZE = config('GRADER_MATERIAL_CACHE_SIZE', default=1024, cast=int)
+# scores and correct rates of quiz reports kept per process
+QUIZ_REPORT_CACHE_SIZE = config('QUIZ_REPORT_CACHE_SIZE', default=64, cast=int)
+# per test case limits of coding questions without their own, in seconds and MB
+GRADER_DEFAULT_TIME_LIMIT = config('GRADER_DEFAULT_TIME_LIMIT', default=5, cast=float)
+GRADER_DEFAULT_MEMORY_LIMIT = config('GRADER_DEFAULT_MEMORY_LIMIT', default=256, cast=int)
+# questions with a reference solution get this multiple of its slowest test case, but at least the minimum
+GRADER_TIME_LIMIT_MULTIPLIER = config('GRADER_TIME_LIMIT_MULTIPLIER', default=5, cast=float)
+GRADER_MIN_TIME_LIMIT = config('GRADER_MIN_TIME_LIMIT', default=0.25, cast=float)
+# stdout a program may print per test case before it is stopped, in bytes
+GRADER_MAX_OUTPUT_BYTES = config('GRADER_MAX_OUTPUT_BYTES', default=1024 * 1024, cast=int)
+# longest a client may wait on a sample test job in one request, in seconds; it holds a web worker
+GRADER_SAMPLE_TEST_MAX_WAIT = config('GRADER_SAMPLE_TEST_MAX_WAIT', default=1, cast=float)
+# seconds a client is told, in Retry-After, to wait before polling an unfinished sample test job again
+GRADER_SAMPLE_TEST_RETRY_AFTER = config('GRADER_SAMPLE_TEST_RETRY_AFTER', default=1, cast=int)
+# grading worker processes started by manage.py grading_worker, and the tasks each one takes from the broker at once
+GRADER_WORKER_PROCESSES = config('GRADER_WORKER_PROCESSES', default=os.cpu_count() or 1, cast=int)
+GRADER_WORKER_PREFETCH = config('GRADER_WORKER_PREFETCH', default=1, cast=int)
+# share of the tasks a grading worker takes from each lane while they all have work, lane:weight pairs
+GRADER_LANE_WEIGHTS = config('GRADER_LANE_WEIGHTS', default='interactive:6,submission:3,regrade:1')
+# a grading worker process is replaced after this many tasks, or once it has used this many MB
+GRADER_WORKER_MAX_JOBS = config('GRADER_WORKER_MAX_JOBS', default=1000, cast=int)
+GRADER_WORKER_MAX_MEMORY = config('GRADER_WORKER_MAX_MEMORY', default=512, cast=int)
+# directory of the grading metrics files of every process, and how often a process rewrites its own, in seconds
+GRADER_METRICS_PATH = config('GRADER_METRICS_PATH', default=os.path.join(tempfile.gettempdir(), 'quizsys-metrics'))
+GRADER_METRICS_FLUSH_INTERVAL = config('GRADER_METRICS_FLUSH_INTERVAL', default=5, cast=float)
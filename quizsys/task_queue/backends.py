@@ -0,0 +1,393 @@
+"""
+Queue backends of the grading task queue.
+
+Every backend publishes message bodies to named queues and hands them to consumers one at a time:
+
+    backend.publish(queue, body)
+    backend.publish(queue, body, attempts)      # a task that raised in a worker `attempts` times
+    backend.start_consuming(queues, prefetch_count)
+    delivery = backend.get(timeout)             # a Delivery, or None if nothing came in time
+    delivery = backend.get(timeout, queues)     # the same, from the first of these queues that has one
+    backend.ack(delivery)                       # once the task is done; unacked tasks are delivered again
+    backend.close()
+    backend.depth(queue)                        # tasks waiting in a queue, for the metrics endpoint
+    backend.requeue(source, destination)        # move the waiting tasks of a queue to another one
+
+GRADER_QUEUE_BACKEND picks the backend of a process: 'pika' (RabbitMQ, the default), 'database'
+(a job table in the Django database, no broker needed) or 'memory' (this process only, for tests
+and single-process benchmarks).
+"""
+import collections
+import datetime
+import os
+import socket
+import threading
+import time
+
+import pika
+from django.db import connection, transaction
+from django.db.models import Q, Case, When, IntegerField
+from django.utils import timezone
+from pika import exceptions
+
+from quizsys.apps.quizzes.models import GradingJob
+from quizsys.settings import BROKER_HOST, GRADER_QUEUE_BACKEND, GRADER_JOB_CLAIM_TIMEOUT
+
+# enqueued_at is the time.time() the task was published at, or None if the backend does not know it;
+# attempts is how many times the task raised in a worker before
+Delivery = collections.namedtuple('Delivery', ('queue', 'body', 'tag', 'enqueued_at', 'attempts'))
+
+# how often the database backend looks for new jobs while waiting, in seconds
+DATABASE_POLL_INTERVAL = 0.5
+
+# jobs the database backend tries to claim in one go when it cannot skip locked rows
+DATABASE_CLAIM_CANDIDATES = 10
+
+
+class PublishError(Exception):
+    pass
+
+
+class QueueBackend(object):
+
+    def publish(self, queue, body, attempts=0):
+        raise NotImplementedError
+
+    def start_consuming(self, queues, prefetch_count=1):
+        raise NotImplementedError
+
+    def get(self, timeout, queues=None):
+        raise NotImplementedError
+
+    def ack(self, delivery):
+        raise NotImplementedError
+
+    def depth(self, queue):
+        raise NotImplementedError
+
+    def requeue(self, source, destination):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Publisher(object):
+    """
+    Publishes persistent messages over one long-lived broker connection, so a request that queues
+    many tasks pays the TCP and AMQP handshakes once per process instead of once per task.
+
+    The channel is in confirm mode, so publish() only returns once the broker has taken the
+    message, and raises PublishError if it refused it. A dropped connection is reopened and the
+    message published again. BlockingConnection is not thread-safe, so publishing is serialized,
+    and a forked child opens its own connection instead of sharing its parent's socket.
+    """
+
+    def __init__(self, host=BROKER_HOST):
+        self.host = host
+        self.connection = None
+        self.channel = None
+        self.pid = None
+        self.declared_queues = set()
+        self._lock = threading.Lock()
+
+    def publish(self, queue, body, attempts=0):
+        with self._lock:
+            try:
+                self._publish(queue, body, attempts)
+            except (exceptions.AMQPConnectionError, exceptions.ChannelClosed, OSError):
+                # the broker restarted or dropped us while idle, one more try on a fresh connection
+                self._reset()
+                self._publish(queue, body, attempts)
+
+    def _publish(self, queue, body, attempts):
+        channel = self._get_channel()
+        if queue not in self.declared_queues:
+            channel.queue_declare(queue=queue, durable=True)
+            self.declared_queues.add(queue)
+        try:
+            # pika cannot encode float headers, hence milliseconds
+            channel.publish(exchange='', routing_key=queue, body=body, mandatory=True,
+                            properties=pika.BasicProperties(delivery_mode=2, headers={
+                                'enqueued_at_ms': int(time.time() * 1000), 'attempts': attempts}))
+        except (exceptions.NackError, exceptions.UnroutableError) as exc:
+            raise PublishError("Broker did not accept the message for %s: %r" % (queue, exc))
+
+    def _get_channel(self):
+        if self.pid != os.getpid():
+            # never touch a connection inherited from the parent, it is still in use there
+            self.connection = None
+            self.channel = None
+        if self.connection is None or not self.connection.is_open or not self.channel.is_open:
+            self._reset()
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+            self.channel = self.connection.channel()
+            self.channel.confirm_delivery()
+            self.pid = os.getpid()
+        return self.channel
+
+    def _reset(self):
+        if self.connection is not None and self.pid == os.getpid():
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.channel = None
+        self.declared_queues = set()
+
+    def depth(self, queue):
+        with self._lock:
+            # passive: only look, a queue nobody declared yet is not created here
+            return self._get_channel().queue_declare(queue=queue, durable=True, passive=True).method.message_count
+
+    def requeue(self, source, destination):
+        """Move the ready messages of a queue to another one and drop the queue once it is empty."""
+        moved = 0
+        with self._lock:
+            channel = self._get_channel()
+            channel.queue_declare(queue=source, durable=True)
+            channel.queue_declare(queue=destination, durable=True)
+            while True:
+                method, properties, body = channel.basic_get(source)
+                if method is None:
+                    break
+                # confirm mode: the copy is taken by the broker before the original is acked
+                channel.publish(exchange='', routing_key=destination, body=body, properties=properties)
+                channel.basic_ack(method.delivery_tag)
+                moved += 1
+            try:
+                # a queue still consumed (its node is alive after all) is left in place
+                channel.queue_delete(queue=source, if_unused=True, if_empty=True)
+            except exceptions.ChannelClosed:
+                # refusing the delete closes the channel
+                self._reset()
+            self.declared_queues.discard(source)
+        return moved
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+
+class PikaBackend(QueueBackend):
+    """
+    RabbitMQ. Consumed messages are buffered here, per queue, until get() hands them out. The
+    prefetch count applies to each queue on its own, so a consumer of several queues always has
+    the next message of each at hand and get() can pick the queue it prefers. A queue deleted under
+    its consumer (the broker cancels the subscription) is declared and subscribed to again.
+    """
+
+    def __init__(self, host=BROKER_HOST):
+        self.host = host
+        self.publisher = Publisher(host)
+        self.connection = None
+        self.channel = None
+        self.queues = []
+        self.consumers = {}
+        self._cancelled = []
+        self._deliveries = collections.defaultdict(collections.deque)
+
+    def publish(self, queue, body, attempts=0):
+        self.publisher.publish(queue, body, attempts)
+
+    def start_consuming(self, queues, prefetch_count=1):
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        self.channel = self.connection.channel()
+        # not global: RabbitMQ then counts the prefetch per consumer, i.e. per queue
+        self.channel.basic_qos(prefetch_count=prefetch_count, all_channels=False)
+        self.channel.add_on_cancel_callback(self._on_cancel)
+        self.queues = list(queues)
+        for queue in queues:
+            self._consume(queue)
+
+    def _consume(self, queue):
+        self.channel.queue_declare(queue=queue, durable=True)
+        self.consumers[self.channel.basic_consume(self._on_message(queue), queue=queue)] = queue
+
+    def _on_cancel(self, method_frame):
+        self._cancelled.append(method_frame.method.consumer_tag)
+
+    def _resubscribe(self):
+        while self._cancelled:
+            consumer_tag = self._cancelled.pop()
+            # lets pika forget the cancelled consumer before the queue gets a new one
+            self.channel.basic_cancel(consumer_tag)
+            self._consume(self.consumers.pop(consumer_tag))
+
+    def _on_message(self, queue):
+        def on_message(ch, method, properties, body):
+            headers = properties.headers or {}
+            enqueued_at_ms = headers.get('enqueued_at_ms')
+            enqueued_at = enqueued_at_ms / 1000.0 if enqueued_at_ms is not None else None
+            self._deliveries[queue].append(Delivery(queue, body, method.delivery_tag, enqueued_at,
+                                                    headers.get('attempts', 0)))
+        return on_message
+
+    def get(self, timeout, queues=None):
+        self._resubscribe()
+        delivery = self._pop(queues or self.queues)
+        if delivery is None:
+            self.connection.process_data_events(time_limit=timeout)
+            delivery = self._pop(queues or self.queues)
+        return delivery
+
+    def _pop(self, queues):
+        for queue in queues:
+            if self._deliveries[queue]:
+                return self._deliveries[queue].popleft()
+        return None
+
+    def ack(self, delivery):
+        self.channel.basic_ack(delivery_tag=delivery.tag)
+
+    def depth(self, queue):
+        # ready messages only, the ones delivered but not yet acked are not counted by the broker
+        return self.publisher.depth(queue)
+
+    def requeue(self, source, destination):
+        return self.publisher.requeue(source, destination)
+
+    def close(self):
+        # messages prefetched but not acked go back to their queue with the connection
+        self._deliveries.clear()
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+        self.publisher.close()
+
+
+class DatabaseBackend(QueueBackend):
+    """
+    GradingJob rows. A consumer claims the oldest unclaimed job and deletes it once done; a claim
+    older than GRADER_JOB_CLAIM_TIMEOUT is taken to belong to a dead consumer and can be claimed
+    again. Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED where the database has it, and
+    otherwise (SQLite) by a conditional UPDATE that only one consumer can win.
+    """
+
+    def __init__(self):
+        self.queues = []
+        self.consumer_id = ""
+
+    def publish(self, queue, body, attempts=0):
+        body = body.decode('utf-8') if isinstance(body, bytes) else body
+        GradingJob.objects.create(queue=queue, body=body, attempts=attempts)
+
+    def start_consuming(self, queues, prefetch_count=1):
+        # jobs are claimed one at a time, there is nothing to prefetch from a table
+        self.queues = list(queues)
+        self.consumer_id = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    def get(self, timeout, queues=None):
+        deadline = time.time() + timeout
+        while True:
+            job = self._claim(queues or self.queues)
+            if job is not None:
+                return Delivery(job.queue, job.body.encode('utf-8'), job.pk, job.created_at.timestamp(), job.attempts)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(DATABASE_POLL_INTERVAL, remaining))
+
+    def ack(self, delivery):
+        GradingJob.objects.filter(pk=delivery.tag).delete()
+
+    def depth(self, queue):
+        return self._claimable([queue]).count()
+
+    def requeue(self, source, destination):
+        # claims are kept, a job claimed by a consumer that is gone is claimed again once stale
+        return GradingJob.objects.filter(queue=source).update(queue=destination)
+
+    def _claimable(self, queues):
+        stale = timezone.now() - datetime.timedelta(seconds=GRADER_JOB_CLAIM_TIMEOUT)
+        return GradingJob.objects.filter(queue__in=queues) \
+            .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale)).order_by('pk')
+
+    def _claim(self, queues):
+        # oldest job of the first queue that has one
+        preference = Case(*[When(queue=queue, then=index) for index, queue in enumerate(queues)],
+                          output_field=IntegerField())
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                job = self._claimable(queues).order_by(preference, 'pk').select_for_update(skip_locked=True).first()
+                if job is not None:
+                    job.claimed_at = timezone.now()
+                    job.claimed_by = self.consumer_id
+                    job.save(update_fields=['claimed_at', 'claimed_by'])
+                return job
+
+        for job in self._claimable(queues).order_by(preference, 'pk')[:DATABASE_CLAIM_CANDIDATES]:
+            claimed_at = timezone.now()
+            claimed = self._claimable(queues).filter(pk=job.pk) \
+                .update(claimed_at=claimed_at, claimed_by=self.consumer_id)
+            if claimed:
+                job.claimed_at = claimed_at
+                job.claimed_by = self.consumer_id
+                return job
+        return None
+
+
+class MemoryBackend(QueueBackend):
+    """Queues in this process. Nothing is persisted and acks are no-ops."""
+
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.consumed_queues = []
+        self._condition = threading.Condition()
+
+    def publish(self, queue, body, attempts=0):
+        with self._condition:
+            body = body.encode('utf-8') if isinstance(body, str) else body
+            self.queues[queue].append((body, time.time(), attempts))
+            self._condition.notify_all()
+
+    def start_consuming(self, queues, prefetch_count=1):
+        self.consumed_queues = list(queues)
+
+    def get(self, timeout, queues=None):
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                for queue in queues or self.consumed_queues:
+                    if self.queues[queue]:
+                        body, enqueued_at, attempts = self.queues[queue].popleft()
+                        return Delivery(queue, body, None, enqueued_at, attempts)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def ack(self, delivery):
+        pass
+
+    def depth(self, queue):
+        with self._condition:
+            return len(self.queues[queue])
+
+    def requeue(self, source, destination):
+        with self._condition:
+            moved = len(self.queues[source])
+            self.queues[destination].extend(self.queues.pop(source))
+            self._condition.notify_all()
+        return moved
+
+
+BACKENDS = {
+    'pika': PikaBackend,
+    'database': DatabaseBackend,
+    'memory': MemoryBackend,
+}
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the queue backend of this process, creating it on first use (and again after a fork)."""
+    global _backend, _backend_pid
+    with _backend_lock:
+        if _backend is None or _backend_pid != os.getpid():
+            _backend = BACKENDS[GRADER_QUEUE_BACKEND]()
+            _backend_pid = os.getpid()
+        return _backend
@@ -0,0 +1,222 @@
+import collections
+import json
+import resource
+import signal
+import threading
+import time
+import traceback
+
+from django.db import close_old_connections, connection
+
+from quizsys.apps.core.metrics import QUEUE_WAIT_SECONDS, TASKS, registry
+from quizsys.apps.questions.caches import result_cache
+from quizsys.apps.questions.graders import grade_question
+from quizsys.apps.questions.models import SampleTestJob
+from quizsys.apps.questions.sandbox import get_pool
+from quizsys.apps.quizzes.grading import parse_task, grade_task
+from quizsys.settings import GRADER_POOL_SIZE, GRADER_WORKER_PREFETCH, GRADER_LANE_WEIGHTS, GRADER_NODE_AFFINITY, \
+    GRADER_NODE_NAME, GRADER_NODE_TTL, GRADER_TASK_MAX_ATTEMPTS
+from quizsys.task_queue.backends import get_backend
+from quizsys.task_queue.new_task import QUIZ_SUBMISSION_QUEUE, SAMPLE_TEST_QUEUE, REGRADE_QUEUE, LANES, \
+    dead_letter_queue
+from quizsys.task_queue.routing import node_queue, lane_queue, heartbeat, hand_over_dead_nodes
+
+# how often the consumer looks up from the queue to see whether it has been asked to stop, in seconds
+POLL_INTERVAL = 1
+
+# how often the consumer checks its node in, well within GRADER_NODE_TTL, in seconds; this is done
+# from a thread of its own, so the node stays alive while the consumer is busy with a long task
+HEARTBEAT_INTERVAL = GRADER_NODE_TTL / 3.0
+
+
+class Consumer(object):
+    """
+    Grades the tasks of the grading lanes until it is told to stop.
+
+    While several lanes have tasks waiting, they are served in proportion to their weights (smooth
+    weighted round robin), so a burst of submissions or a batch regrade slows the sample tests of
+    the students down only by its share. A lane left out of the weights is not consumed at all.
+    Within a lane, the queue of its own node (see routing.py) comes before the shared queue.
+
+    A task that raises is queued again behind the waiting tasks, and set aside in the dead letter
+    queue of its lane once it has raised GRADER_TASK_MAX_ATTEMPTS times, so that a task that can
+    never be graded does not take the workers down over and over.
+
+    SIGTERM stops it once the task in hand is graded; tasks prefetched but not started go back to
+    the queue when the backend is closed. It also stops by itself after max_jobs tasks or once its
+    peak memory grows past max_memory MB, so that a supervisor can replace it with a fresh process.
+    """
+
+    def __init__(self, prefetch_count=GRADER_WORKER_PREFETCH, max_jobs=None, max_memory=None, backend=None,
+                 lanes=GRADER_LANE_WEIGHTS, node=GRADER_NODE_NAME):
+        self.prefetch_count = prefetch_count
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.backend = backend
+        # a handler returns 'failed' for a task it gave up on, which is acked all the same
+        self.handlers = {
+            QUIZ_SUBMISSION_QUEUE: self.on_grading_task,
+            REGRADE_QUEUE: self.on_grading_task,
+            SAMPLE_TEST_QUEUE: self.on_sample_test
+        }
+        self.weights = parse_lanes(lanes)
+        self.credits = dict.fromkeys(self.weights, 0)
+        self.node = node if GRADER_NODE_AFFINITY else None
+        self.jobs = 0
+        self.stopping = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        # start the sandbox interpreters now rather than on the first submission
+        if GRADER_POOL_SIZE > 0:
+            get_pool()
+
+        backend = self.backend or get_backend()
+        backend.start_consuming(self.queues(self.weights), self.prefetch_count)
+        if self.node:
+            threading.Thread(target=self.keep_checking_in, args=(backend,), name='heartbeat', daemon=True).start()
+        try:
+            print(' [*] Waiting for messages. To exit press CTRL+C')
+            while not self.stopping:
+                order = self.lane_order()
+                delivery = backend.get(POLL_INTERVAL, self.queues(order))
+                if delivery is None:
+                    continue
+                lane = lane_queue(delivery.queue)
+                self.lane_served(order, lane)
+                if delivery.enqueued_at is not None:
+                    QUEUE_WAIT_SECONDS.observe(max(time.time() - delivery.enqueued_at, 0), queue=lane)
+                try:
+                    outcome = self.handlers[lane](delivery.body) or 'ok'
+                except Exception:
+                    traceback.print_exc()
+                    # the copy is queued before the task is acked, a crash in between grades it twice at worst
+                    outcome = self.retry(backend, delivery, lane)
+                    # a connection the failure left broken is replaced for the next task
+                    close_old_connections()
+                TASKS.inc(queue=lane, outcome=outcome)
+                backend.ack(delivery)
+                self.job_done()
+        finally:
+            self._stopped.set()
+            backend.close()
+            if GRADER_POOL_SIZE > 0:
+                get_pool().close()
+            # the supervisor ends its workers with os._exit, which skips atexit
+            registry.flush(force=True)
+
+    def stop(self, *args):
+        self.stopping = True
+        self._stopped.set()
+
+    def retry(self, backend, delivery, lane):
+        attempts = delivery.attempts + 1
+        if attempts < GRADER_TASK_MAX_ATTEMPTS:
+            print("[x] Task %r raised (attempt %d), queued again" % (delivery.body, attempts))
+            backend.publish(delivery.queue, delivery.body, attempts)
+            return 'retried'
+        print("[x] Task %r raised %d times, moved to %s" % (delivery.body, attempts, dead_letter_queue(lane)))
+        backend.publish(dead_letter_queue(lane), delivery.body, attempts)
+        return 'dead'
+
+    def queues(self, lanes):
+        """Queues to consume for these lanes, in order of preference."""
+        queues = []
+        for lane in lanes:
+            queues += [node_queue(lane, self.node), lane] if self.node else [lane]
+        return queues
+
+    def keep_checking_in(self, backend):
+        try:
+            while not self._stopped.is_set():
+                self.check_in(backend)
+                self._stopped.wait(HEARTBEAT_INTERVAL)
+        finally:
+            # Django opened a connection for this thread
+            connection.close()
+
+    def check_in(self, backend):
+        """Tell the publishers this node is alive and how busy, and take over the queues of dead nodes."""
+        try:
+            heartbeat(self.node, sum(backend.depth(node_queue(lane, self.node)) for lane in self.weights))
+            for node in hand_over_dead_nodes(backend, list(LANES.values())):
+                print("[x] Node %s stopped checking in, moved its tasks to the shared queues" % node)
+        except Exception as exc:
+            # routing falls back to the shared queues on its own, grading goes on
+            print("[x] Could not check node %s in: %r" % (self.node, exc))
+
+    def lane_order(self):
+        """Queues of the lanes, the one whose turn it is first."""
+        return sorted(self.weights, key=lambda queue: -(self.credits[queue] + self.weights[queue]))
+
+    def lane_served(self, order, queue):
+        # lanes that came before it were empty: they sit this round out and do not save up turns
+        served = order.index(queue)
+        for lane in order[:served]:
+            self.credits[lane] = 0
+        for lane in order[served:]:
+            self.credits[lane] += self.weights[lane]
+        self.credits[queue] -= sum(self.weights[lane] for lane in order[served:])
+
+    def on_grading_task(self, body):
+        print("[x] Received grading task: %r" % body)
+
+        graded = grade_task(parse_task(body))
+
+        print("[x] Graded %d question submissions of task: %r (result cache: %r)" % (len(graded), body,
+                                                                                     result_cache.stats()))
+
+    def on_sample_test(self, body):
+        print("[x] Received sample test job pk: %r" % body)
+
+        try:
+            job = SampleTestJob.objects.select_related('question').get(pk=body.decode())
+        except SampleTestJob.DoesNotExist:
+            # the question was deleted in the meantime
+            return
+
+        try:
+            results = grade_question(job.question, job.response, sample_test=True)
+        except Exception as exc:
+            print("[x] Sample test job pk: %r failed: %r" % (body, exc))
+            job.status = 'FAILED'
+            job.save()
+            return 'failed'
+        else:
+            job.results = json.dumps(results)
+            job.status = 'DONE'
+            job.save()
+        print("[x] Ran sample test job pk: %r" % body)
+
+    def job_done(self):
+        self.jobs += 1
+        if self.max_jobs and self.jobs >= self.max_jobs:
+            print("[x] Graded %d tasks, making way for a fresh worker" % self.jobs)
+            self.stopping = True
+        # ru_maxrss is in KB on Linux
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        if self.max_memory and memory > self.max_memory:
+            print("[x] Using %.0f MB, making way for a fresh worker" % memory)
+            self.stopping = True
+
+
+def parse_lanes(spec):
+    """
+    Weights of the lanes to consume, by queue, from "lane:weight,..." (e.g. "interactive:6,submission:3").
+    Raises ValueError for an unknown lane or a weight that is not a positive integer.
+    """
+    weights = collections.OrderedDict()
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        lane, _, weight = item.partition(':')
+        if lane.strip() not in LANES:
+            raise ValueError("Unknown grading lane %r, expected one of %s" % (lane, ", ".join(LANES)))
+        weight = int(weight or 1)
+        if weight < 1:
+            raise ValueError("The weight of grading lane %r must be positive" % lane)
+        weights[LANES[lane.strip()]] = weight
+    if not weights:
+        raise ValueError("No grading lane to consume")
+    return weights
@@ -1,13 +1,61 @@
-import pika
+import json
 
+from quizsys.apps.core.metrics import collect, gauge
+from quizsys.task_queue.backends import get_backend
+from quizsys.task_queue.routing import router, live_nodes, node_queue
 
-def grade_quiz_submission_task(question_submission_pk):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-    channel = connection.channel()
+QUIZ_SUBMISSION_QUEUE = 'task_queue'
+SAMPLE_TEST_QUEUE = 'sample_test_queue'
+REGRADE_QUEUE = 'regrade_queue'
 
-    channel.queue_declare(queue='task_queue', durable=True)
+# grading lanes and their queues: students waiting on a sample test, final submissions, batch regrades
+LANES = {
+    'interactive': SAMPLE_TEST_QUEUE,
+    'submission': QUIZ_SUBMISSION_QUEUE,
+    'regrade': REGRADE_QUEUE,
+}
 
-    channel.basic_publish(exchange='', routing_key='task_queue', body=question_submission_pk, properties=pika.BasicProperties(delivery_mode=2))
 
+def dead_letter_queue(queue):
+    """Where the tasks of a lane that kept raising in the workers are set aside. Nothing consumes it."""
+    return "%s_dead" % queue
+
+
+# question_pk is the question a task is about, which picks the grading host it goes to (see routing.py)
+
+def grade_quiz_submission_task(quiz_submission_pk, question_pk=None):
+    publish(QUIZ_SUBMISSION_QUEUE, json.dumps({'quiz_submission': quiz_submission_pk}), question_pk)
+    print('[x] Sent quiz submission with pk: %d' % quiz_submission_pk)
+
+
+def grade_question_submission_task(question_submission_pk, question_pk=None):
+    publish(QUIZ_SUBMISSION_QUEUE, question_submission_pk, question_pk)
     print('[x] Sent question submission with pk: ' + question_submission_pk)
-    connection.close()
+
+
+def regrade_quiz_submission_task(quiz_submission_pk, question_pk=None):
+    publish(REGRADE_QUEUE, json.dumps({'quiz_submission': quiz_submission_pk}), question_pk)
+
+
+def run_sample_test_task(sample_test_job_pk, question_pk=None):
+    publish(SAMPLE_TEST_QUEUE, sample_test_job_pk, question_pk)
+    print('[x] Sent sample test job with pk: ' + sample_test_job_pk)
+
+
+def publish(queue, body, question_pk=None):
+    get_backend().publish(router.route(queue, question_pk), body)
+
+
+def grading_metrics():
+    """Metrics of every grading process, plus the depth of the grading queues right now."""
+    queues = list(LANES.values()) + [dead_letter_queue(queue) for queue in LANES.values()]
+    for node in live_nodes().values_list('name', flat=True):
+        queues += [node_queue(queue, node) for queue in LANES.values()]
+    depths = []
+    for queue in queues:
+        try:
+            depths.append(({'queue': queue}, get_backend().depth(queue)))
+        except Exception as exc:
+            # the rest of the metrics are still worth serving while the broker is away
+            print('[x] Could not get the depth of %s: %r' % (queue, exc))
+    return collect() + gauge('quizsys_grading_queue_depth', 'Grading tasks waiting in a queue', depths)
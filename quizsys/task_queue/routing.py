@@ -0,0 +1,117 @@
+"""
+Question affinity of grading tasks.
+
+Every grading host (node) checks in with a GradingNode row. A task about a question goes to the
+queue of the node that owns the question on a consistent hash ring of the live nodes, e.g.
+"task_queue@grader-2" instead of "task_queue", so each node sees a small set of questions and
+keeps their grading material cached. When a node joins or leaves only the questions of its share
+of the ring move.
+
+Tasks go to the shared queue of their lane instead when there is no question to route by, no live
+node, or the owner has more than GRADER_NODE_MAX_BACKLOG tasks waiting. Every node consumes the
+shared queues after its own, and the queues of a node that stopped checking in are moved to them.
+Tasks of every lane are routed, so every node has to run workers for every lane.
+"""
+import bisect
+import datetime
+import hashlib
+import threading
+import time
+
+from django.utils import timezone
+
+from quizsys.apps.quizzes.models import GradingNode
+from quizsys.settings import GRADER_NODE_AFFINITY, GRADER_NODE_TTL, GRADER_NODE_MAX_BACKLOG
+
+# points of each node on the ring; more of them spread the questions more evenly
+RING_REPLICAS = 160
+
+# how long a publishing process trusts its view of the live nodes, in seconds
+NODES_REFRESH_INTERVAL = 10
+
+
+class HashRing(object):
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted((_hash("%s#%d" % (node, replica)), node)
+                        for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def get(self, key):
+        """The node that owns a key, None if the ring is empty."""
+        if not self._nodes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, _hash(str(key))) % len(self._nodes)]
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def node_queue(queue, node):
+    return "%s@%s" % (queue, node)
+
+
+def lane_queue(queue):
+    """The shared queue of the lane a (possibly per node) queue belongs to."""
+    return queue.split('@', 1)[0]
+
+
+class Router(object):
+    """Routes tasks on a view of the live nodes that is refreshed every NODES_REFRESH_INTERVAL."""
+
+    def __init__(self):
+        self.ring = HashRing([])
+        self.overloaded = frozenset()
+        self.refreshed_at = 0
+        self._lock = threading.Lock()
+
+    def route(self, queue, question_pk):
+        if not GRADER_NODE_AFFINITY or question_pk is None:
+            return queue
+        self.refresh()
+        node = self.ring.get(question_pk)
+        if node is None or node in self.overloaded:
+            return queue
+        return node_queue(queue, node)
+
+    def refresh(self):
+        with self._lock:
+            if time.time() - self.refreshed_at < NODES_REFRESH_INTERVAL:
+                return
+            nodes = live_nodes().values_list('name', 'backlog')
+            self.ring = HashRing([name for name, backlog in nodes])
+            self.overloaded = frozenset(name for name, backlog in nodes if backlog > GRADER_NODE_MAX_BACKLOG)
+            self.refreshed_at = time.time()
+
+
+router = Router()
+
+
+def live_nodes():
+    return GradingNode.objects.filter(heartbeat_at__gte=timezone.now() - datetime.timedelta(seconds=GRADER_NODE_TTL))
+
+
+def heartbeat(node, backlog):
+    GradingNode.objects.update_or_create(name=node, defaults={'heartbeat_at': timezone.now(), 'backlog': backlog})
+
+
+def hand_over_dead_nodes(backend, queues):
+    """
+    Move the tasks waiting in the queues of nodes that stopped checking in to the shared queues.
+    Any number of consumers may run this at once: only the one that deletes a node moves its tasks.
+    Returns the names of the nodes handed over.
+    """
+    # publishers may still route to a node for one refresh after it stopped checking in
+    stale = timezone.now() - datetime.timedelta(seconds=GRADER_NODE_TTL + NODES_REFRESH_INTERVAL)
+    handed_over = []
+    for node in GradingNode.objects.filter(heartbeat_at__lt=stale):
+        deleted, _ = GradingNode.objects.filter(pk=node.pk, heartbeat_at=node.heartbeat_at).delete()
+        if not deleted:
+            # it checked in again, or another consumer got to it first
+            continue
+        for queue in queues:
+            backend.requeue(node_queue(queue, node.name), queue)
+        handed_over.append(node.name)
+    return handed_over
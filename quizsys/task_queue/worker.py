@@ -1,4 +1,3 @@
-import pika
 import time
 
 import os
@@ -6,8 +5,6 @@ from django.conf import settings
 from django.apps import apps
 from decouple import config
 
-from quizsys.apps.questions.graders import grade_question
-
 conf = {
     'INSTALLED_APPS' : [
          'rest_framework',
@@ -38,42 +35,7 @@ settings.configure(**conf)
 apps.populate(settings.INSTALLED_APPS)
 
 
-from quizsys.apps.quizzes.models import QuestionSubmission, ScoreDistribution
-
-connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-channel = connection.channel()
-
-channel.queue_declare(queue='task_queue', durable=True)
-
-
-def callback(ch, method, properties, body):
-    print("[x] Received question submission pk: %r" % body)
-
-    instance = QuestionSubmission.objects.get(pk=body.decode())
-
-    quiz_submission = instance.quiz_submission
-    quiz = quiz_submission.quiz
-    question = instance.question
-    response = instance.response
-
-    question_point = ScoreDistribution.objects.get(question=question, quiz=quiz).point
-    grading_result = grade_question(question, response, file_suffix=instance.pk)
-    response_correct = grading_result["status"]
-
-    question_score = grading_result.pop('score', response_correct)
-    quiz_submission.score += question_point * question_score
-    quiz_submission.save()
-
-    instance.is_correct = response_correct
-    instance.score = question_point * question_score
-    instance.is_graded = True
-    instance.extra_info = grading_result.pop('extra_info', "")
-    instance.save()
-    ch.basic_ack(delivery_tag=method.delivery_tag)
-
-
-channel.basic_qos(prefetch_count=1)
-channel.basic_consume(callback, queue='task_queue')
+from quizsys.task_queue.consumer import Consumer
 
-print(' [*] Waiting for messages. To exit press CTRL+C')
-channel.start_consuming()
+# a single consumer grading one task at a time; manage.py grading_worker runs a supervised group of them
+Consumer(prefetch_count=1).run()